@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""Offline benchmarks of igg.py against the local mock server.
+
+    python bench.py --comments 5000 --contribs 20000 --latency 0.02
+
+Every scenario runs in its own process so that its peak RSS is its own.
+Requests are counted by the mock server. Use --json to get the results in
+a machine readable form, e.g. to compare them across revisions.
+"""
+
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+import mock_server
+
+
+SCENARIOS = ['startup', 'timestamps', 'new_comments', 'new_contribs', 'sync', 'cycle', 'analytics', 'catalogue']
+
+
+def run_scenario(name, server_url, args):
+    """Run the scenario in this process and return its results.
+    """
+    started = time.time()
+    import igg
+    import_time = time.time() - started
+    igg.BASE_URL = server_url + '/1.1'
+    igg.IFTTT_URL = server_url + '/ifttt/{event}/{key}'
+    igg.CONFIGS.update({'api_key': 'key',
+                        'campaign_id': 1,
+                        'update_interval': 60,
+                        'slack_url': server_url + '/slack',
+                        'ifttt_maker_key': 'maker',
+                        'slack_rate_limit': 0,
+                        'parallel_checks': args.parallel})
+    igg._state().set('access_token', 'access')
+    igg._state().set('refresh_token', 'refresh')
+    result = {'scenario': name}
+
+    if name == 'startup':
+        result['import_time'] = import_time
+        started = time.time()
+        igg.authenticate()
+        result['authenticate_time'] = time.time() - started
+        started = time.time()
+        igg.Campaign(1).load()
+        result['load_time'] = time.time() - started
+        result['time'] = result['import_time'] + result['authenticate_time'] + result['load_time']
+    elif name == 'timestamps':
+        import iso8601
+        stamps = [time.strftime('%Y-%m-%dT%H:%M:%S-08:00', time.gmtime(mock_server.EPOCH + i * 61))
+                  for i in range(args.comments + args.contribs)]
+        # What igg.py did before the fast path
+        result['iso8601_us'] = _time_per_call(lambda s: time.mktime(iso8601.parse_date(s).timetuple()), stamps)
+        result['fast_path_us'] = _time_per_call(igg._parse_ts, stamps)
+        result['cached_miss_us'] = _time_per_call(igg._convert_to_ts, stamps)
+        result['cached_hit_us'] = _time_per_call(igg._convert_to_ts, stamps[-1000:])
+        result['time'] = 0
+    elif name in ('new_comments', 'new_contribs'):
+        started = time.time()
+        count = sum(1 for _ in getattr(igg, name)(0, 1))
+        result['time'] = time.time() - started
+        result['items'] = count
+        result['items_per_sec'] = count / result['time']
+    elif name == 'sync':
+        igg.authenticate()
+        campaign = igg.Campaign(1, sync_existing=True)
+        campaign.load()
+        started = time.time()
+        igg.check_now(campaign)
+        result['check_time'] = time.time() - started
+        igg._dispatcher().flush(timeout=600)
+        result['time'] = time.time() - started
+        result['delivery_time'] = result['time'] - result['check_time']
+        result['items'] = args.comments + args.contribs
+        result['items_per_sec'] = result['items'] / result['time']
+    elif name == 'cycle':
+        igg.authenticate()
+        campaign = igg.Campaign(1)
+        campaign.load()
+        # Start from the newest items so that only the new ones are seen
+        for kind, key in (('comments', 'comment'), ('contributions', 'contrib')):
+            newest = _get_json(server_url + '/1.1/campaigns/1/{}.json'.format(kind))['response']
+            if newest:
+                cursor = igg.Cursor()
+                cursor.advance(igg._convert_to_ts(newest[0]['created_at']), newest[0]['id'])
+                cursor.save(campaign.state, key)
+        igg.check_now(campaign)
+        _post(server_url + '/_reset')
+        latencies = []
+        for _ in range(args.cycles):
+            _post(server_url + '/_grow?kind=comments&count={}'.format(args.new_per_cycle))
+            _post(server_url + '/_grow?kind=contributions&count={}'.format(args.new_per_cycle))
+            started = time.time()
+            igg.check_now(campaign)
+            latencies.append(time.time() - started)
+        igg._dispatcher().flush(timeout=600)
+        latencies.sort()
+        result['cycles'] = args.cycles
+        result['time'] = sum(latencies)
+        result['latency_mean'] = sum(latencies) / len(latencies)
+        result['latency_p95'] = latencies[int(len(latencies) * 0.95)]
+    elif name == 'analytics':
+        campaign = igg.Campaign(1)
+        rows = args.backers
+        started = time.time()
+        for i in range(rows):
+            campaign.stats.add(igg.Contrib(i, mock_server.EPOCH + i * 60, 10 * (i % 7 + 1), i % args.perks,
+                                           u'Perk {}'.format(i % args.perks), u'Backer', None,
+                                           2000 + i % 10 if i % 3 == 0 else None))
+        campaign.stats.commit()
+        campaign.state.commit()
+        result['add_us'] = (time.time() - started) / rows * 1e6
+        since = mock_server.EPOCH + rows * 30
+        for backend, numpy in (('numpy', igg._numpy()), ('python', False)):
+            if numpy is False and backend == 'numpy':
+                continue
+            igg.NUMPY = numpy
+            started = time.time()
+            campaign.stats.summary(since)
+            campaign.stats.by_perk(since)
+            campaign.stats.by_referrer(since)
+            campaign.stats.by_hour(since)
+            result[backend + '_queries_ms'] = (time.time() - started) * 1e3
+        started = time.time()
+        igg.Campaign(1).stats.summary()
+        result['load_ms'] = (time.time() - started) * 1e3
+        result['rows'] = rows
+        result['time'] = 0
+    elif name == 'catalogue':
+        igg.authenticate()
+        igg.CONFIGS['catalogue_sync_limit'] = args.campaigns + 1
+        started = time.time()
+        result['synced'] = igg._catalogue().sync(args.campaigns + 1)
+        result['sync_time'] = time.time() - started
+        started = time.time()
+        for _ in range(100):
+            igg._catalogue().search(u'smart rob')
+        result['local_search_ms'] = (time.time() - started) * 10
+        started = time.time()
+        list(igg.search_campaigns(u'smart robot', max_page=2, only_mine=False))
+        result['search_campaigns_ms'] = (time.time() - started) * 1e3
+        started = time.time()
+        igg.Catalogue(igg._state('catalogue'))
+        result['load_ms'] = (time.time() - started) * 1e3
+        result['time'] = result['sync_time']
+    result['peak_rss_kb'] = _peak_rss_kb()
+    return result
+
+
+def _time_per_call(func, args):
+    """Return the time of a call in microseconds.
+    """
+    started = time.time()
+    for arg in args:
+        func(arg)
+    return (time.time() - started) / len(args) * 1e6
+
+
+def _peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # It's in bytes on Mac OS X and in kilobytes elsewhere.
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+def _get_json(url):
+    return json.loads(urllib2.urlopen(url).read())
+
+
+def _post(url):
+    return json.loads(urllib2.urlopen(urllib2.Request(url, data='')).read())
+
+
+def _count_requests(server_url):
+    requests = _get_json(server_url + '/_stats')['requests']
+    api = sum(count for path, count in requests.iteritems() if path.startswith('/1.1/'))
+    notifications = sum(count for path, count in requests.iteritems()
+                        if path == '/slack' or path == '/ifttt')
+    return api, notifications
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark igg.py against a local mock server.')
+    parser.add_argument('scenarios', nargs='*', default=SCENARIOS,
+                        help='scenarios to run (default: all of {})'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--comments', type=int, default=1000)
+    parser.add_argument('--contribs', type=int, default=1000)
+    parser.add_argument('--perks', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every response')
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--backers', type=int, default=100000, help='contributions in the analytics scenario')
+    parser.add_argument('--campaigns', type=int, default=10000, help='other campaigns in the catalogue scenario')
+    parser.add_argument('--new-per-cycle', type=int, default=2)
+    parser.add_argument('--parallel', action='store_true', help='enable parallel_checks')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # Run a single scenario against the server of the parent process.
+        print json.dumps(run_scenario(args.scenarios[0], args.child, args))
+        return
+
+    campaign = mock_server.Campaign(comments=args.comments, contribs=args.contribs,
+                                    perks=args.perks, page_size=args.page_size)
+    server = mock_server.MockServer(campaign, latency=args.latency, campaigns=args.campaigns).start()
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for name in args.scenarios:
+        workdir = tempfile.mkdtemp(prefix='igg-bench-')
+        try:
+            _post(server.url + '/_reset')
+            cmd = [sys.executable, os.path.join(here, 'bench.py'), name, '--child', server.url] + \
+                [arg for arg in sys.argv[1:] if arg not in args.scenarios and arg != '--json']
+            env = dict(os.environ, PYTHONPATH=here)
+            output = subprocess.check_output(cmd, cwd=workdir, env=env)
+            result = json.loads(output.strip().splitlines()[-1])
+            result['api_requests'], result['notifications'] = _count_requests(server.url)
+            if name == 'cycle':
+                result['api_requests_per_cycle'] = float(result['api_requests']) / result['cycles']
+            results.append(result)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    server.shutdown()
+
+    if args.json:
+        print json.dumps(results, indent=2)
+        return
+    for result in results:
+        print '{:<14}'.format(result.pop('scenario')),
+        print '  '.join('{}={}'.format(key, round(value, 4) if isinstance(value, float) else value)
+                        for key, value in sorted(result.items()))
+
+
+if __name__ == '__main__':
+    main()
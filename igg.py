@@ -14,186 +14,1761 @@ Author: Taehyun Park (taehyun@thenaran.com)
 """
 
 
+import time
+IMPORT_STARTED = time.time()
+
 import logging
-import requests
 import json
-from tinydb import TinyDB, where
-import time
-import iso8601
-import getpass
-import subprocess
+import sys
+import threading
+import heapq
+import itertools
+import Queue
+import os
+import hashlib
+import collections
+import functools
+import contextlib
+import array
+import bisect
+import importlib
+import io
+import random
+import re
+import calendar
+import datetime
+import math
+# requests, iso8601 and the modules only some commands need are imported
+# where they are used, which keeps one-shot runs (--once) quick to start.
+
+
+BASE_URL = 'https://api.indiegogo.com/1.1'
+IFTTT_URL = 'https://maker.ifttt.com/trigger/{event}/with/key/{key}'
+AUTH_URL = 'https://auth.indiegogo.com/oauth/token'
+STATE_DIR = 'state'
+STORES = {}
+STORES_LOCK = threading.Lock()
+
+CONFIGS = {}
+
+HTTP = None
+API_BUDGET = None
+RESPONSE_CACHE = {}
+RESPONSE_CACHE_LOCK = threading.Lock()
+DISPATCHER = None
+DISPATCHER_LOCK = threading.Lock()
+ACCOUNTS = None
+ACCOUNTS_LOCK = threading.Lock()
+TOKENS = None
+TOKENS_LOCK = threading.Lock()
+EVENTS = None
+EVENTS_LOCK = threading.Lock()
+IJSON = None
+NUMPY = None
+CATALOGUE = None
+CATALOGUE_LOCK = threading.Lock()
+LEASES = None
+# The limits of the API calls of this thread, if any: the time by which
+# they must be done (deadline) and an event set once they're no longer
+# wanted (cancelled)
+API_CALLS = threading.local()
+
+
+class HttpClient(object):
+    """Keep-alive HTTP client with per-host connection pools.
+
+    Every Indiegogo, Slack and IFTTT request goes through one instance so
+    that TCP and TLS handshakes are paid once per host, not once per call.
+    """
+
+    def __init__(self, pool_connections=10, pool_size=10, timeout=30,
+                 retries=3, backoff=0.5):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries,
+                      backoff_factor=backoff,
+                      status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def _http():
+    global HTTP
+    if HTTP is None:
+        HTTP = HttpClient(pool_connections=CONFIGS.get('http_pool_connections', 10),
+                          pool_size=CONFIGS.get('http_pool_size', 10),
+                          timeout=CONFIGS.get('http_timeout', 30),
+                          retries=CONFIGS.get('http_retries', 3),
+                          backoff=CONFIGS.get('http_backoff', 0.5))
+    return HTTP
+
+
+class Metrics(object):
+    """Counters, gauges and histograms, rendered in the Prometheus text format.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        """Set the gauge. The value can be a function called when it's read.
+        """
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # Count of each bucket, then the sum and the count
+                histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+        typed = set()
+        for kind, items in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in items:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE {} {}'.format(name, kind))
+                value = value() if callable(value) else value
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+            for bound, count in zip(self.BUCKETS, histogram):
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', bound),)), count))
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', '+Inf'),)), histogram[-1]))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), histogram[-2]))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Return the current values in a flat dict, e.g. for a log line.
+        """
+        snapshot = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items() + self.gauges.items():
+                snapshot[name + _format_labels(labels)] = value() if callable(value) else value
+            for (name, labels), histogram in self.histograms.items():
+                snapshot[name + '_count' + _format_labels(labels)] = histogram[-1]
+                snapshot[name + '_mean' + _format_labels(labels)] = float(histogram[-2]) / histogram[-1]
+        return snapshot
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels) + '}'
+
+
+def serve_metrics(port):
+    """Serve the metrics on http://localhost:<port>/ in the background.
+    """
+    import BaseHTTPServer
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = METRICS.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def log_metrics(interval):
+    """Log the metrics as a JSON line every interval seconds in the background.
+    """
+    def target():
+        while True:
+            time.sleep(interval)
+            logging.info("metrics %s", json.dumps(METRICS.snapshot(), sort_keys=True))
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+
+METRICS = Metrics()
+
+
+def get_campaign_info(ident=None, if_changed=False):
+    path = 'campaigns/{ident}.json'.format(ident=ident or CONFIGS['campaign_id'])
+    return _api_get_if_changed(path) if if_changed else _api_get(path)
+
+
+def get_perks_info(ident=None, if_changed=False):
+    path = 'campaigns/{ident}/perks.json'.format(ident=ident or CONFIGS['campaign_id'])
+    return _api_get_if_changed(path) if if_changed else _api_get(path)
+
+
+# The fields of the comments and contributions used by the checks; the rest
+# of the API records are dropped as soon as they're parsed.
+Comment = collections.namedtuple('Comment', 'id ts text avatar_url')
+Contrib = collections.namedtuple('Contrib', 'id ts amount perk_id perk_label name avatar_url referrer_id')
+
+
+def _project_comment(comment):
+    return Comment(comment['id'],
+                   _convert_to_ts(comment['created_at']),
+                   comment['text'],
+                   comment['account']['avatar_url'])
+
+
+def _project_contrib(contrib):
+    perk = contrib['perk'] or {}
+    return Contrib(contrib['id'],
+                   _convert_to_ts(contrib['created_at']),
+                   _number(contrib['amount']),
+                   perk.get('id'),
+                   # Contributed without selecting any perk
+                   perk.get('label', 'No perk'),
+                   contrib['contributor_name'] if 'contributor_name' in contrib else contrib['by'],
+                   contrib['avatar_url'],
+                   contrib.get('referrer_id'))
+
+
+def _number(value):
+    # ijson parses the numbers with a fraction as Decimal
+    if value is None or isinstance(value, (int, long, float)):
+        return value
+    return int(value) if value == int(value) else float(value)
+
+
+def new_comments(cursor, ident=None):
+    """Yield the comments newer than the cursor (or a timestamp) as Comment, newest first.
+    """
+    if not isinstance(cursor, Cursor):
+        cursor = Cursor(cursor)
+    pages = _paginate('campaigns/{ident}/comments.json'.format(ident=ident or CONFIGS['campaign_id']),
+                      _project_comment)
+    try:
+        for comment in pages:
+            if not cursor.is_new(comment.ts, comment.id):
+                break
+            yield comment
+    finally:
+        pages.close()
+
+
+def new_contribs(cursor, ident=None):
+    """Yield the contributions newer than the cursor (or a timestamp) as Contrib, newest first.
+    """
+    if not isinstance(cursor, Cursor):
+        cursor = Cursor(cursor)
+    pages = _paginate('campaigns/{ident}/contributions.json'.format(ident=ident or CONFIGS['campaign_id']),
+                      _project_contrib)
+    try:
+        for contrib in pages:
+            if not cursor.is_new(contrib.ts, contrib.id):
+                break
+            yield contrib
+    finally:
+        pages.close()
+
+
+def _paginate(path, project, fanout=None, page_size=None, first_page=1, numbered=False):
+    """Yield the items of every page of the API endpoint in order, projected.
+
+    It starts from `first_page`, and with numbered, each item is yielded
+    along with the number of its page.
+
+    While a page is being consumed, up to `fanout` following pages are
+    fetched ahead in parallel. It starts with a single page and widens each
+    time a page is consumed entirely, so a poll that stops on the first
+    page costs only one request. Pages fetched ahead are cancelled once the
+    generator is closed: those whose requests aren't sent yet never are.
+    """
+    fanout = fanout or CONFIGS.get('page_fanout', 4)
+    page_size = page_size or CONFIGS.get('page_size')
+    params = {'per_page': page_size} if page_size else {}
+    fetching = {}
+    cancelled = threading.Event()
+    page = next_page = first_page
+    window = 1
+    try:
+        while True:
+            while next_page < page + window:
+                fetch = functools.partial(_api_get_items, path, project, page=next_page, **params)
+                fetching[next_page] = _run_in_thread(_fetch_unless, cancelled, fetch)
+                next_page += 1
+            logging.info("%s on page %s", path, page)
+            thread, box = fetching.pop(page)
+            thread.join()
+            METRICS.inc('igg_pages_fetched_total', endpoint=re.sub(r'\d+', ':id', path))
+            if 'error' in box:
+                raise box['error'][0], box['error'][1], box['error'][2]
+            if not box['result']:
+                break
+            for item in box['result']:
+                yield (page, item) if numbered else item
+            page += 1
+            window = min(fanout, window * 2)
+    finally:
+        cancelled.set()
+        fetching.clear()
+        METRICS.observe('igg_pages_per_fetch', page - first_page + 1, endpoint=re.sub(r'\d+', ':id', path))
+
+
+CampaignEntry = collections.namedtuple('CampaignEntry', 'id title slug members')
+
+
+def _project_campaign(campaign):
+    return CampaignEntry(campaign['id'],
+                         campaign['title'],
+                         campaign.get('slug'),
+                         [member['account_id'] for member in campaign.get('team_members') or []])
+
+
+def all_campaigns():
+    """Yield every campaign as CampaignEntry, newest first.
+    """
+    pages = _paginate('campaigns.json', _project_campaign)
+    try:
+        for campaign in pages:
+            yield campaign
+    finally:
+        pages.close()
+
+
+def search_campaigns(terms, max_page=10, only_mine=True):
+    """Yield the campaigns whose titles match the terms as CampaignEntry.
+
+    The local catalogue is searched first, after syncing it if it's older
+    than `catalogue_refresh` seconds. The remote search follows for the
+    campaigns it doesn't have, which are then added to it.
+    """
+    catalogue = _catalogue()
+    if catalogue.stale(CONFIGS.get('catalogue_refresh', 3600)):
+        catalogue.sync(CONFIGS.get('catalogue_sync_limit', 1000))
+    account_id = CONFIGS['account_id'] if only_mine else None
+    seen = set()
+    for campaign in catalogue.search(terms, account_id):
+        seen.add(campaign.id)
+        yield campaign
+    page = 1
+    try:
+        while True:
+            payload = {'title': terms,
+                       'sort': only_mine and 'new' or 'popular_all',
+                       'page': page
+                       }
+            logging.info("On page %s.", page)
+            page += 1
+            if page > max_page:
+                break
+            response = _api_get('search/campaigns.json', **payload)
+            if not response:
+                break
+            for campaign in response:
+                campaign = _project_campaign(campaign)
+                catalogue.add(campaign)
+                if campaign.id not in seen and (not only_mine or account_id in campaign.members):
+                    seen.add(campaign.id)
+                    yield campaign
+    finally:
+        catalogue.store.commit()
+
+
+def get_current_account():
+    return _api_get('me.json')
+
+
+def get_account_info(ident):
+    return _api_get('accounts/{ident}.json'.format(ident=ident))
+
+
+def _api_get(path, **params):
+    """Make a GET request to the Indiegogo API and return its response.
+
+    Requests made on behalf of every monitored campaign share one rate-limit
+    budget (`api_rate_limit` requests per second).
+    """
+    resp = _api_request(path, params)
+    result = json.loads(resp.text)
+    return result['response']
+
+
+def _api_get_items(path, project, **params):
+    """Like _api_get() for a list response, but return its items projected.
+
+    With ijson (and one of its C backends) installed, the items are parsed
+    one at a time, so a whole page of full records is never held in memory.
+    """
+    resp = _api_request(path, params)
+    ijson = _ijson()
+    if not ijson:
+        return [project(item) for item in json.loads(resp.text)['response']]
+    return [project(item) for item in ijson.items(io.BytesIO(resp.content), 'response.item')]
+
+
+def _ijson():
+    global IJSON
+    if IJSON is None:
+        IJSON = False
+        # The pure Python backend is too slow to be worth the memory it saves.
+        for backend in ('yajl2_c', 'yajl2_cffi', 'yajl2'):
+            try:
+                IJSON = importlib.import_module('ijson.backends.' + backend)
+                break
+            except Exception:
+                pass
+    return IJSON
+
+
+def _numpy():
+    global NUMPY
+    if NUMPY is None:
+        try:
+            import numpy
+            NUMPY = numpy
+        except ImportError:
+            NUMPY = False
+    return NUMPY
+
+
+def _api_get_if_changed(path, **params):
+    """Like _api_get(), but return None if nothing changed since the last handled response.
+
+    The validators (ETag/Last-Modified) of the previous response are sent
+    along, and a digest of the body is compared when the server sends none,
+    so unchanged documents are never parsed. The response is returned with
+    its validators, which count only once passed to _keep_validators()
+    after the response was handled, so a response that is dropped or fails
+    to be handled is returned again the next time.
+    """
+    key = (path, tuple(sorted(params.items())))
+    with RESPONSE_CACHE_LOCK:
+        cached = RESPONSE_CACHE.get(key, {})
+    headers = {}
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    resp = _api_request(path, params, headers)
+    if resp.status_code == 304:
+        return None, None
+    digest = hashlib.sha1(resp.content).hexdigest()
+    if digest == cached.get('digest'):
+        return None, None
+    validators = {'key': key,
+                  'etag': resp.headers.get('ETag'),
+                  'last_modified': resp.headers.get('Last-Modified'),
+                  'digest': digest}
+    result = json.loads(resp.text)
+    return result['response'], validators
+
+
+def _keep_validators(validators):
+    """Remember the validators of a response returned by _api_get_if_changed() once it was handled.
+    """
+    if validators is None:
+        return
+    validators = dict(validators)
+    with RESPONSE_CACHE_LOCK:
+        RESPONSE_CACHE[validators.pop('key')] = validators
+
+
+def _api_request(path, params, headers=None):
+    access_token = _tokens().access_token()
+    resp = _api_send(path, params, headers, access_token)
+    if resp.status_code == 401:
+        # The access token expired or was revoked before its time
+        resp = _api_send(path, params, headers, _tokens().refresh(access_token))
+    if resp.status_code in (401, 429):
+        _raise_for_status(resp, _api_budget())
+    return resp
+
+
+def _api_send(path, params, headers, access_token):
+    payload = {'api_token': CONFIGS['api_key'],
+               'access_token': access_token
+               }
+    payload.update(params)
+    cancelled = getattr(API_CALLS, 'cancelled', None)
+    if cancelled is not None and cancelled.is_set():
+        raise CallCancelled(path)
+    _api_budget().acquire()
+    if cancelled is not None and cancelled.is_set():
+        # It was waiting for the budget meanwhile
+        raise CallCancelled(path)
+    started = time.time()
+    kwargs = {}
+    deadline = getattr(API_CALLS, 'deadline', None)
+    if deadline is not None:
+        if deadline <= started:
+            raise DeadlineExceeded(path)
+        kwargs['timeout'] = min(deadline - started, CONFIGS.get('http_timeout', 30))
+    resp = _http().get('{base}/{path}'.format(base=BASE_URL, path=path), params=payload, headers=headers,
+                       **kwargs)
+    METRICS.observe('igg_request_seconds', time.time() - started, endpoint=re.sub(r'\d+', ':id', path))
+    return resp
+
+
+class RateLimited(Exception):
+    """Raised on a 429 response.
+    """
+
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__("Rate limited for {} seconds.".format(retry_after))
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Raised on an API call made after the check it's for timed out.
+    """
+
+    def __init__(self, path):
+        super(DeadlineExceeded, self).__init__("Deadline exceeded before calling {}.".format(path))
+
+
+class CallCancelled(Exception):
+    """Raised on an API call whose result is no longer wanted, e.g. a page fetched ahead.
+    """
+
+    def __init__(self, path):
+        super(CallCancelled, self).__init__("Cancelled calling {}.".format(path))
+
+
+def _raise_for_status(resp, bucket):
+    """Raise an exception on an error response.
+
+    On 429, the bucket is held for as long as the Retry-After header asks.
+    """
+    if resp.status_code == 429:
+        retry_after = _parse_retry_after(resp.headers.get('Retry-After'))
+        bucket.hold(retry_after)
+        raise RateLimited(retry_after)
+    resp.raise_for_status()
+
+
+def _parse_retry_after(value, default=60):
+    if not value:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        import email.utils
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return default
+        return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter. A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.held_until = 0
+        self.lock = threading.Lock()
+
+    def hold(self, seconds):
+        """Let nothing through for the seconds (e.g. Retry-After).
+        """
+        with self.lock:
+            self.held_until = max(self.held_until, time.time() + seconds)
+
+    def acquire(self):
+        while self.held_until > time.time():
+            time.sleep(min(1, self.held_until - time.time()))
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _api_budget():
+    global API_BUDGET
+    if API_BUDGET is None:
+        API_BUDGET = TokenBucket(CONFIGS.get('api_rate_limit', 0),
+                                 CONFIGS.get('api_burst', 5))
+    return API_BUDGET
+
+
+class TokenManager(object):
+    """OAuth tokens of the Indiegogo account, kept in the state store.
+
+    The access token is refreshed `margin` seconds before it expires, or
+    when the API rejects it. Concurrent callers share a single refresh, and
+    so do worker processes.
+    """
+
+    def __init__(self, store, margin=300):
+        self.store = store
+        self.margin = margin
+        self.lock = threading.Lock()
+
+    def login(self, email, password):
+        self._request({'grant_type': 'password',
+                       'credential_type': 'email',
+                       'email': email,
+                       'password': password})
+
+    def access_token(self):
+        access_token = self.store.get('access_token')
+        expires_at = self.store.get('expires_at')
+        if expires_at is not None and time.time() >= expires_at - self.margin:
+            return self.refresh(access_token)
+        return access_token
+
+    def refresh(self, stale):
+        """Replace the stale access token and return the new one.
+
+        If another thread has replaced it already, its token is returned.
+        """
+        with self.lock, _exclusive():
+            if LEASES is not None:
+                # Another worker process may have refreshed it already.
+                self.store = _state(reload=True)
+            if self.store.get('access_token') == stale:
+                logging.info("Refreshing the access token.")
+                self._request({'grant_type': 'refresh_token',
+                               'refresh_token': self.store.get('refresh_token')})
+            return self.store.get('access_token')
+
+    def _request(self, data):
+        resp = _http().post(AUTH_URL, data=data)
+        METRICS.inc('igg_token_requests_total', grant=data['grant_type'], status=str(resp.status_code))
+        resp.raise_for_status()
+        tokens = resp.json()
+        self.store.set('access_token', tokens['access_token'])
+        if tokens.get('refresh_token'):
+            self.store.set('refresh_token', tokens['refresh_token'])
+        if tokens.get('expires_in'):
+            self.store.set('expires_at', time.time() + tokens['expires_in'])
+        else:
+            self.store.delete('expires_at')
+        self.store.commit()
+
+
+def _tokens():
+    global TOKENS
+    with TOKENS_LOCK:
+        if TOKENS is None:
+            TOKENS = TokenManager(_state())
+    return TOKENS
+
+
+class StateStore(object):
+    """Key/value state kept in memory and persisted in an append-only journal.
+
+    Changes are buffered until commit(), which appends them to the journal
+    as a single line with a single fsync, so a commit survives a crash
+    either entirely or not at all. The journal is rewritten as a snapshot once it holds
+    more than `compact_after` entries.
+    """
+
+    def __init__(self, path, compact_after=1000):
+        self.path = path
+        self.compact_after = compact_after
+        self.data = {}
+        self.pending = []
+        self.journal_len = 0
+        self.lock = threading.RLock()
+        self._load()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.pending.append(['set', key, value])
+
+    def items(self):
+        with self.lock:
+            return self.data.items()
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.data:
+                del self.data[key]
+                self.pending.append(['del', key])
+
+    def commit(self):
+        with self.lock:
+            if not self.pending:
+                return
+            started = time.time()
+            if self.journal_len + len(self.pending) > self.compact_after:
+                self._compact()
+            else:
+                self._append(self.pending)
+            self.pending = []
+            METRICS.observe('igg_state_commit_seconds', time.time() - started)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            good = 0
+            for line in iter(f.readline, ''):
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError(line)
+                    entry = json.loads(line)
+                except ValueError:
+                    # A write torn by a crash. Cut it off, or the next commit
+                    # would be appended to the broken line and be lost too.
+                    logging.warn("Dropping a broken entry at the end of %s.", self.path)
+                    f.truncate(good)
+                    break
+                good += len(line)
+                # A line is either one entry or all the entries of a commit.
+                for entry in entry if isinstance(entry[0], list) else [entry]:
+                    if entry[0] == 'set':
+                        self.data[entry[1]] = entry[2]
+                    else:
+                        self.data.pop(entry[1], None)
+                    self.journal_len += 1
+
+    def _append(self, entries):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entries) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_len += len(entries)
+
+    def _compact(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for key, value in self.data.iteritems():
+                f.write(json.dumps(['set', key, value]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.rename(tmp, self.path)
+        except OSError:
+            # Windows doesn't replace existing files on rename.
+            os.remove(self.path)
+            os.rename(tmp, self.path)
+        self.journal_len = len(self.data)
+
+
+def _state(namespace='default', reload=False):
+    """Return the state store of the namespace.
+
+    With reload, it's read again from the disk, e.g. after another worker
+    process changed it.
+    """
+    with STORES_LOCK:
+        if namespace not in STORES or reload:
+            if not os.path.isdir(STATE_DIR):
+                os.makedirs(STATE_DIR)
+                _migrate_tinydb('data.json')
+            STORES[namespace] = StateStore(os.path.join(STATE_DIR, namespace + '.journal'))
+        return STORES[namespace]
+
+
+def _migrate_tinydb(path):
+    """Import the state of older versions kept in a TinyDB file.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as f:
+        tables = json.loads(f.read() or '{}')
+    for table, records in tables.iteritems():
+        store = StateStore(os.path.join(STATE_DIR,
+                                        ('default' if table == '_default' else table) + '.journal'))
+        for record in records.itervalues():
+            store.set(record['type'], record['ts'] if 'ts' in record else record['value'])
+        store.commit()
+    logging.info("Migrated the state in %s.", path)
+
+
+class EventLog(object):
+    """Append-only log of every detected event, for other programs to consume.
+
+    Each event is a JSON line with the next offset of the log, the time, the
+    campaign, its type and its data. The log is split into segment files
+    named after the offset of their first event. A new segment is started
+    once the last one holds `segment_size` bytes, and only the newest
+    `max_segments` segments are kept (0: all of them).
+
+    Events are buffered until commit(), like the state, and get their
+    offsets then. Worker processes share the log. Readers can run in other
+    processes and only ever see committed events.
+    """
+
+    def __init__(self, path, segment_size=16 * 1024 * 1024, max_segments=0):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.next_offset = None
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def append(self, campaign, kind, data, ts=None):
+        with self.lock:
+            self.pending.append({'ts': ts or time.time(),
+                                 'campaign': campaign,
+                                 'type': kind,
+                                 'data': data})
+
+    def commit(self):
+        with self.lock, _exclusive():
+            if not self.pending:
+                return
+            if self.next_offset is None or LEASES is not None:
+                # Other workers may have appended to it since
+                self.next_offset = self._recover()
+            lines = []
+            for event in self.pending:
+                event['offset'] = self.next_offset
+                self.next_offset += 1
+                lines.append(json.dumps(event))
+            segments = self.segments()
+            if not segments or os.path.getsize(self._segment_path(segments[-1])) >= self.segment_size:
+                segments.append(self.next_offset - len(lines))
+                if self.max_segments:
+                    for base in segments[:-self.max_segments]:
+                        os.remove(self._segment_path(base))
+            with open(self._segment_path(segments[-1]), 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending = []
+
+    def segments(self):
+        """Return the base offsets of the segments, oldest first.
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.log'))
+
+    def read(self, offset=0):
+        """Yield the committed events from the offset on, oldest first.
+
+        If the offset was deleted already, it starts from the oldest event.
+        """
+        segments = self.segments()
+        for base in segments[max(0, bisect.bisect_right(segments, offset) - 1):]:
+            try:
+                f = open(self._segment_path(base), 'r')
+            except IOError:
+                # Deleted in the meantime
+                continue
+            with f:
+                # The offsets in a segment have no gaps, so there's no need
+                # to parse the lines before the offset.
+                for line in itertools.islice(f, max(0, offset - base), None):
+                    if not line.endswith('\n'):
+                        # Still being written
+                        return
+                    yield json.loads(line)
+
+    def tail(self, offset=0, interval=1.0):
+        """Yield the events from the offset on, waiting for new ones forever.
+        """
+        while True:
+            for event in self.read(offset):
+                offset = event['offset'] + 1
+                yield event
+            time.sleep(interval)
+
+    def _segment_path(self, base):
+        return os.path.join(self.path, '{:020d}.log'.format(base))
+
+    def _recover(self):
+        """Return the next offset, dropping the last event if a crash tore it.
+        """
+        segments = self.segments()
+        if not segments:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            return 0
+        with open(self._segment_path(segments[-1]), 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            tail = ''
+            # Read backwards until the last complete line is in the tail
+            while pos > 0 and tail.count('\n') < 2:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                tail = f.read(step) + tail
+            complete = tail[:tail.rfind('\n') + 1]
+            if len(complete) < len(tail):
+                logging.warn("Dropping a broken event at the end of %s.", self.path)
+                f.truncate(pos + len(complete))
+        if not complete:
+            return segments[-1]
+        return json.loads(complete[:-1].rsplit('\n', 1)[-1])['offset'] + 1
+
+
+def _events():
+    """Return the event log, or None if it's disabled.
+    """
+    global EVENTS
+    with EVENTS_LOCK:
+        if EVENTS is None and CONFIGS.get('event_log', 'events'):
+            EVENTS = EventLog(CONFIGS.get('event_log', 'events'),
+                              segment_size=CONFIGS.get('event_segment_size', 16 * 1024 * 1024),
+                              max_segments=CONFIGS.get('event_segments', 8))
+    return EVENTS
+
+
+def _emit(campaign, kind, data, ts=None):
+    events = _events()
+    if events is not None:
+        events.append(campaign.ident, kind, data, ts)
+
+
+class Cursor(object):
+    """Position in a feed: a high-water mark plus the IDs of the newest items.
+
+    An item is new unless its ID was seen or it's older than the mark, so
+    items sharing a timestamp are neither skipped nor sent twice. Only the
+    last `size` IDs are remembered.
+    """
+
+    def __init__(self, ts=0, ids=(), size=100, legacy=None):
+        self.ts = ts
+        self.ids = collections.deque(ids, maxlen=size)
+        self.seen = set(self.ids)
+        self.legacy = legacy
+
+    @classmethod
+    def load(cls, state, key):
+        value = state.get(key) or 0
+        size = CONFIGS.get('cursor_ids', 100)
+        if isinstance(value, dict):
+            return cls(value['ts'], value['ids'], size=size)
+        return cls(size=size, legacy=value or None)
+
+    def save(self, state, key):
+        if self.legacy is not None and not self._migrate():
+            # Nothing was parsed yet, keep the mark of the older version
+            return
+        state.set(key, {'ts': self.ts, 'ids': list(self.ids)})
+
+    def is_new(self, ts, ident):
+        if self.legacy is not None:
+            self._migrate()
+        return ident not in self.seen and ts >= self.ts
+
+    def advance(self, ts, ident):
+        if self.legacy is not None:
+            self._migrate()
+        if len(self.ids) == self.ids.maxlen:
+            self.seen.discard(self.ids[0])
+        self.ids.append(ident)
+        self.seen.add(ident)
+        self.ts = max(self.ts, ts)
+
+    def _migrate(self):
+        """Convert the mark of older versions, once the offset of the API is known.
+
+        They kept only a whole second: the wall clock of the API, in its own
+        offset, read as local time. The item of that second was notified
+        already.
+        """
+        if API_OFFSET is None:
+            return False
+        wall = calendar.timegm(time.localtime(self.legacy))
+        self.ts = max(self.ts, wall - API_OFFSET + 1)
+        self.legacy = None
+        return True
+
+
+class Spool(object):
+    """New items spilled to a temporary file in chunks and read back oldest first.
+
+    The API lists the newest items first but they are notified oldest first.
+    Only one chunk is kept in memory, however big the backlog is. The items
+    are namedtuples of the given type and are spilled as plain lists.
+    """
+
+    def __init__(self, record, chunk_size=100):
+        self.record = record
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.offsets = []
+        self.file = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        self.chunk.append(item)
+        self.count += 1
+        if len(self.chunk) >= self.chunk_size:
+            self._spill()
+
+    def chunks(self):
+        """Yield the chunks oldest first, each of them ordered oldest first.
+        """
+        if self.chunk:
+            # The chunk still in memory has the oldest items.
+            yield list(reversed(self.chunk))
+        for offset in reversed(self.offsets):
+            self.file.seek(offset)
+            yield [self.record._make(item) for item in reversed(json.loads(self.file.readline()))]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _spill(self):
+        if self.file is None:
+            import tempfile
+            self.file = tempfile.TemporaryFile()
+        self.file.seek(0, os.SEEK_END)
+        self.offsets.append(self.file.tell())
+        self.file.write(json.dumps(self.chunk) + '\n')
+        self.chunk = []
+
+
+class PerkIndex(object):
+    """The last seen claims of each perk of a campaign, kept in its state.
+
+    Only the perks whose counts changed since the last update are evaluated,
+    against a warning threshold computed whenever their availability
+    changes. A perk is warned about once `warn_claims` or fewer are left, or
+    once `warn_percent` percent of it is claimed, whichever comes first.
+    """
+
+    def __init__(self, state, campaign, warn_claims=10, warn_percent=None, samples=10):
+        self.state = state
+        self.campaign = campaign
+        self.warn_claims = warn_claims
+        self.warn_percent = warn_percent
+        self.samples = samples
+        self.perks = {}
+
+    def update(self, perks, now=None):
+        """Record the counts of the perks and return the events they caused.
+
+        An event is a (kind, perk, entry) tuple, where kind is 'changed' for
+        every perk whose counts changed, then 'almost sold out' or 'sold out'.
+        """
+        now = now or time.time()
+        events = []
+        for perk in perks:
+            entry = self._entry(perk['id'])
+            claimed = perk['number_claimed']
+            available = perk['number_available']
+            if claimed == entry['claimed'] and available == entry['available']:
+                continue
+            if available != entry['available']:
+                entry['warn_at'] = self.warn_at(available)
+                # More of it may have been made available since the warnings
+                entry['sold_out'] = entry['sold_out'] and claimed >= available
+                entry['warned'] = entry['warned'] and claimed >= entry['warn_at']
+            entry['claimed'] = claimed
+            entry['available'] = available
+            entry['samples'] = (entry['samples'] + [[now, claimed]])[-self.samples:]
+            events.append(('changed', perk, entry))
+            if available and claimed >= available:
+                if not entry['sold_out']:
+                    entry['sold_out'] = True
+                    events.append(('sold out', perk, entry))
+            elif entry['warn_at'] is not None and claimed >= entry['warn_at']:
+                if not entry['warned']:
+                    entry['warned'] = True
+                    events.append(('almost sold out', perk, entry))
+            self.state.set(self._key(perk['id']), entry)
+        return events
+
+    def warn_at(self, available):
+        """Return the claims at which a perk of the availability is warned about.
+        """
+        if not available:
+            return None
+        thresholds = []
+        if self.warn_claims is not None:
+            thresholds.append(available - self.warn_claims)
+        if self.warn_percent is not None:
+            thresholds.append(int(math.ceil(available * self.warn_percent / 100.0)))
+        return min(thresholds) if thresholds else None
+
+    @staticmethod
+    def velocity(entry):
+        """Return the claims per hour over the recorded samples, if any.
+        """
+        if len(entry['samples']) < 2:
+            return None
+        (first_ts, first), (last_ts, last) = entry['samples'][0], entry['samples'][-1]
+        if last_ts <= first_ts:
+            return None
+        return (last - first) * 3600.0 / (last_ts - first_ts)
+
+    @staticmethod
+    def eta(entry):
+        """Return the estimated seconds until the perk sells out, if it does.
+        """
+        velocity = PerkIndex.velocity(entry)
+        if not entry['available'] or not velocity or velocity <= 0:
+            return None
+        return max(0, entry['available'] - entry['claimed']) * 3600.0 / velocity
+
+    def _entry(self, ident):
+        entry = self.perks.get(ident)
+        if entry is None:
+            entry = self.state.get(self._key(ident))
+            if entry is None:
+                # The markers of the versions before the index (with their
+                # names swapped).
+                entry = {'claimed': None,
+                         'available': None,
+                         'warn_at': None,
+                         'samples': [],
+                         'warned': bool(self.state.get('soldout-' + str(ident))),
+                         'sold_out': bool(self.state.get('almost-' + str(ident)))}
+            self.perks[ident] = entry
+            labels = {'campaign': str(self.campaign), 'perk': str(ident)}
+            METRICS.gauge('igg_perk_claims_per_hour', lambda: PerkIndex.velocity(entry) or 0, **labels)
+            METRICS.gauge('igg_perk_sellout_eta_seconds',
+                          lambda: PerkIndex.eta(entry) if PerkIndex.eta(entry) is not None else float('nan'),
+                          **labels)
+        return entry
+
+    @staticmethod
+    def _key(ident):
+        return 'perk-' + str(ident)
+
+
+class Coalescer(object):
+    """Turns bursts of notifications of a kind into digests.
+
+    A notification is sent right away unless another one of its kind was
+    sent less than `window` seconds ago. In that case it's added to the
+    burst of the window instead: its count, its total amount, the count
+    and total per group (e.g. perk) and the last `top` items. When the
+    window ends, the burst is sent as one digest and the next window
+    starts. The bursts are saved in the campaign state on commit(), along
+    with the cursors.
+    """
+
+    def __init__(self, state, window=0, top=5):
+        self.state = state
+        self.window = window
+        self.top = top
+        self.bursts = {}
+        self.dirty = set()
+
+    def admit(self, kind, item, amount=0, group=None, now=None):
+        """Return whether the notification should be sent right away.
+        """
+        if not self.window:
+            return True
+        now = now or time.time()
+        burst = self._burst(kind)
+        self.dirty.add(kind)
+        if burst is None or (not burst['count'] and now >= burst['opened'] + self.window):
+            # Quiet until now
+            self.bursts[kind] = self._open(now)
+            return True
+        burst['count'] += 1
+        burst['total'] += amount
+        if group is not None:
+            counts = burst['groups'].setdefault(group, [0, 0])
+            counts[0] += 1
+            counts[1] += amount
+        burst['items'] = (burst['items'] + [item])[-self.top:]
+        return False
+
+    def due(self, kinds, now=None):
+        """Return the (kind, burst) of the bursts whose window ended.
+
+        Each of them is reset for the next window.
+        """
+        now = now or time.time()
+        bursts = []
+        for kind in kinds:
+            burst = self._burst(kind)
+            if burst and burst['count'] and now >= burst['opened'] + self.window:
+                bursts.append((kind, burst))
+                self.bursts[kind] = self._open(now)
+                self.dirty.add(kind)
+        return bursts
+
+    def next_due(self, kinds):
+        """Return when the next burst is due, if there's any.
+        """
+        dues = [burst['opened'] + self.window for burst in
+                (self._burst(kind) for kind in kinds) if burst and burst['count']]
+        return min(dues) if dues else None
+
+    def top_groups(self, burst):
+        """Return the [group, count, total] of the largest groups of the burst.
+        """
+        groups = sorted(burst['groups'].iteritems(), key=lambda item: (-item[1][0], -item[1][1]))
+        return [[group, count, total] for group, (count, total) in groups[:self.top]]
+
+    def commit(self):
+        for kind in self.dirty:
+            self.state.set(self._key(kind), self.bursts[kind])
+        self.dirty.clear()
+
+    def _burst(self, kind):
+        if kind not in self.bursts:
+            self.bursts[kind] = self.state.get(self._key(kind))
+        return self.bursts[kind]
+
+    @staticmethod
+    def _open(now):
+        return {'opened': now, 'count': 0, 'total': 0, 'groups': {}, 'items': []}
+
+    @staticmethod
+    def _key(kind):
+        return 'burst-' + kind
+
+
+class Catalogue(object):
+    """Local catalogue of the Indiegogo campaigns, kept in a state store.
+
+    Campaigns are looked up by the words of their titles (or prefixes of
+    them) and by the accounts of their team members, through inverted
+    indexes built in memory on load. sync() only fetches the campaigns
+    created since the last one.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.entries = {}
+        self.words = collections.defaultdict(set)
+        self.accounts = collections.defaultdict(set)
+        self.vocabulary = None
+        self.lock = threading.RLock()
+        for key, value in store.items():
+            if key.startswith('campaign-'):
+                self._index(CampaignEntry(*value))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, campaign):
+        """Add or update the campaign and return whether it changed.
+        """
+        with self.lock:
+            old = self.entries.get(campaign.id)
+            if old == campaign:
+                return False
+            if old is not None:
+                self._unindex(old)
+            self._index(campaign)
+            self.store.set('campaign-' + str(campaign.id), list(campaign))
+            return True
+
+    def search(self, terms, account_id=None):
+        """Return the campaigns with a title word starting with each of the
+        terms (all of them if none), of the account if given, newest first.
+        """
+        with self.lock:
+            ids = None
+            for term in _title_words(terms):
+                matches = set()
+                for word in self._starting_with(term):
+                    matches |= self.words[word]
+                ids = matches if ids is None else ids & matches
+                if not ids:
+                    break
+            if ids is None:
+                ids = set(self.entries)
+            if account_id is not None:
+                ids &= self.accounts.get(account_id, set())
+            return sorted((self.entries[ident] for ident in ids), key=lambda campaign: -campaign.id)
+
+    def stale(self, max_age):
+        # An unfinished sync is continued right away
+        return bool(self.store.get('sync_resume')) or time.time() - self.store.get('synced_at', 0) >= max_age
+
+    def sync(self, limit=1000):
+        """Add the campaigns created since the last sync, up to the limit.
+
+        A sync cut short by the limit saves the range of IDs it went through
+        and the page it reached, and the next one continues from that page
+        below that range. Campaigns created in between are left to the sync
+        after that.
+        """
+        added = 0
+        synced = self.store.get('synced_newest', 0)
+        resume = self.store.get('sync_resume')
+        # Older versions saved no page
+        low, high, page = (list(resume or [None, 0]) + [1])[:3]
+        complete = True
+        # The pages before were synced, and the campaigns created since
+        # only push the rest further.
+        campaigns = _paginate('campaigns.json', _project_campaign, first_page=page, numbered=True)
+        try:
+            for page, campaign in campaigns:
+                # The newest campaigns come first, so the rest were synced already.
+                if campaign.id <= synced:
+                    break
+                if resume and campaign.id >= resume[0]:
+                    continue
+                if added >= limit:
+                    complete = False
+                    break
+                self.add(campaign)
+                low = campaign.id if low is None else min(low, campaign.id)
+                high = max(high, campaign.id)
+                added += 1
+        finally:
+            campaigns.close()
+        if complete:
+            self.store.set('synced_newest', max(synced, high))
+            self.store.delete('sync_resume')
+        else:
+            self.store.set('sync_resume', [low, high, page])
+        self.store.set('synced_at', time.time())
+        self.store.commit()
+        logging.info("Added %s campaigns to the catalogue.", added)
+        return added
+
+    def _index(self, campaign):
+        self.entries[campaign.id] = campaign
+        for word in _title_words(campaign.title):
+            if word not in self.words:
+                self.vocabulary = None
+            self.words[word].add(campaign.id)
+        for account_id in campaign.members:
+            self.accounts[account_id].add(campaign.id)
+
+    def _unindex(self, campaign):
+        for word in _title_words(campaign.title):
+            self.words[word].discard(campaign.id)
+        for account_id in campaign.members:
+            self.accounts[account_id].discard(campaign.id)
+
+    def _starting_with(self, prefix):
+        if self.vocabulary is None:
+            self.vocabulary = sorted(self.words)
+        i = bisect.bisect_left(self.vocabulary, prefix)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(prefix):
+            yield self.vocabulary[i]
+            i += 1
+
+
+def _title_words(title):
+    return set(re.findall(r'\w+', (title or u'').lower(), re.UNICODE))
+
+
+def _catalogue():
+    global CATALOGUE
+    with CATALOGUE_LOCK:
+        if CATALOGUE is None:
+            CATALOGUE = Catalogue(_state('catalogue'))
+    return CATALOGUE
+
 
+class ContribStats(object):
+    """Columnar store of the contributions of a campaign, for analytics.
 
-BASE_URL = 'https://api.indiegogo.com/1.1'
-DB = TinyDB('data.json')
+    The amount, time, perk and referrer (-1 if none) of each contribution
+    are kept in arrays, one file per column, that commit() appends the new
+    rows to. The number of rows is saved in the campaign state along with
+    the contributions cursor, so the rows of a commit that didn't complete
+    are dropped on load. The queries are vectorized with numpy if it's
+    installed.
+    """
 
-try:
-    # Read configurations
-    with open('config.json', 'r') as f:
-        CONFIGS = json.loads(f.read())
-except:
-    CONFIGS = {}
+    COLUMNS = (('amount', 'd'), ('ts', 'd'), ('perk', 'l'), ('referrer', 'l'))
 
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+        self.columns = None
+        self.saved = 0
+        self.lock = threading.RLock()
 
-def get_campaign_info():
-    payload = {'api_token': CONFIGS['api_key'],
-               'access_token': CONFIGS['access_token'],
-              }
-    resp = requests.get(
-        '{base}/campaigns/{ident}.json'.format(base=BASE_URL,
-                                               ident=CONFIGS['campaign_id']),
-        params=payload)
-    result = json.loads(resp.text)
-    return result['response']
+    def __len__(self):
+        with self.lock:
+            return len(self._columns()['ts'])
 
+    def add(self, contrib):
+        with self.lock:
+            columns = self._columns()
+            columns['amount'].append(contrib.amount or 0)
+            columns['ts'].append(contrib.ts)
+            columns['perk'].append(-1 if contrib.perk_id is None else contrib.perk_id)
+            columns['referrer'].append(-1 if contrib.referrer_id is None else contrib.referrer_id)
+            if contrib.perk_id is not None and str(contrib.perk_id) not in self.labels:
+                self.labels[str(contrib.perk_id)] = contrib.perk_label
+                self.state.set('stats_perks', self.labels)
 
-def get_perks_info():
-    payload = {'api_token': CONFIGS['api_key'],
-               'access_token': CONFIGS['access_token'],
-               }
-    resp = requests.get(
-        '{base}/campaigns/{ident}/perks.json'.format(base=BASE_URL,
-                                                     ident=CONFIGS['campaign_id']),
-        params=payload)
-    result = json.loads(resp.text)
-    return result['response']
+    def commit(self):
+        with self.lock:
+            if self.columns is None or self.saved == len(self.columns['ts']):
+                return
+            for name, _ in self.COLUMNS:
+                with open(os.path.join(self.path, name), 'ab') as f:
+                    self.columns[name][self.saved:].tofile(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.saved = len(self.columns['ts'])
+            self.state.set('stats_rows', self.saved)
 
+    def summary(self, since=0):
+        """Return the count and the total amount of the contributions since the time.
+        """
+        with self.lock:
+            amount, ts = self._column('amount'), self._column('ts')
+            np = _numpy()
+            if np:
+                mask = ts >= since
+                return int(mask.sum()), float(amount[mask].sum())
+            amounts = [a for a, t in itertools.izip(amount, ts) if t >= since]
+            return len(amounts), float(sum(amounts))
 
-def new_comments(last_ts):
-    page = 1
-    go = True
-    while go:
-        payload = {'api_token': CONFIGS['api_key'],
-                   'access_token': CONFIGS['access_token'],
-                   'page': page}
-        page += 1
-        logging.info("comments on page %s", page)
-        resp = requests.get(
-            '{base}/campaigns/{ident}/comments.json'.format(base=BASE_URL,
-                                                            ident=CONFIGS['campaign_id']),
-            params=payload)
-        result = json.loads(resp.text)
-        if not result['response']:
-            break
-        for comment in result['response']:
-            created_ts = _convert_to_ts(comment['created_at'])
-            if last_ts >= created_ts:
-                go = False
-                break
-            yield comment
+    def by_perk(self, since=0):
+        """Return {perk id (-1: no perk): [count, total]} of the contributions since the time.
+        """
+        return self._group('perk', since)
 
+    def by_referrer(self, since=0):
+        """Return {referrer id: [count, total]} of the referred contributions since the time.
+        """
+        groups = self._group('referrer', since)
+        groups.pop(-1, None)
+        return groups
 
-def new_contribs(last_ts):
-    page = 1
-    go = True
-    while go:
-        payload = {'api_token': CONFIGS['api_key'],
-                   'access_token': CONFIGS['access_token'],
-                   'page': page}
-        page += 1
-        resp = requests.get(
-            '{base}/campaigns/{ident}/contributions.json'.format(base=BASE_URL,
-                                                                 ident=CONFIGS['campaign_id']),
-            params=payload)
-        result = json.loads(resp.text)
-        if not result['response']:
-            break
-        for contrib in result['response']:
-            created_ts = _convert_to_ts(contrib['created_at'])
-            if last_ts >= created_ts:
-                go = False
-                break
-            yield contrib
+    def by_hour(self, since=0):
+        """Return {start of the hour: [count, total]} of the contributions since the time.
+        """
+        return self._group('hour', since)
 
+    def velocity(self, window=86400, now=None):
+        """Return the funds raised per hour over the last window seconds.
+        """
+        _, total = self.summary((now or time.time()) - window)
+        return total * 3600 / window
 
-def all_campaigns():
-    page = 1
-    while True:
-        payload = {'api_token': CONFIGS['api_key'],
-                   'access_token': CONFIGS['access_token'],
-                   'page': page}
-        logging.info("On page %s.", page)
-        page += 1
-        resp = requests.get('{base}/campaigns.json'.format(base=BASE_URL), params=payload)
-        result = json.loads(resp.text)
-        if not result['response']:
-            break
-        for campaign in result['response']:
-            yield campaign
+    def label(self, perk):
+        with self.lock:
+            self._columns()
+            return self.labels.get(str(perk), 'No perk')
 
+    def _group(self, key, since):
+        with self.lock:
+            amount, ts = self._column('amount'), self._column('ts')
+            np = _numpy()
+            if np:
+                mask = ts >= since
+                if key == 'hour':
+                    keys = (ts[mask] // 3600 * 3600).astype(np.int64)
+                else:
+                    keys = self._column(key)[mask]
+                uniques, inverse = np.unique(keys, return_inverse=True)
+                counts = np.bincount(inverse, minlength=len(uniques))
+                totals = np.bincount(inverse, weights=amount[mask], minlength=len(uniques))
+                return dict((k, [c, t]) for k, c, t in
+                            itertools.izip(uniques.tolist(), counts.tolist(), totals.tolist()))
+            if key == 'hour':
+                keys = (int(t // 3600 * 3600) for t in ts)
+            else:
+                keys = self._column(key)
+            groups = {}
+            for k, a, t in itertools.izip(keys, amount, ts):
+                if t >= since:
+                    group = groups.setdefault(k, [0, 0.0])
+                    group[0] += 1
+                    group[1] += a
+            return groups
 
-def search_campaigns(terms, max_page=10, only_mine=True):
-    page = 1
-    while True:
-        payload = {'api_token': CONFIGS['api_key'],
-                   'access_token': CONFIGS['access_token'],
-                   'title': terms,
-                   'sort': only_mine and 'new' or 'popular_all',
-                   'page': page
-                   }
-        logging.info("On page %s.", page)
-        page += 1
-        if page > max_page:
-            break
-        resp = requests.get('{base}/search/campaigns.json'.format(base=BASE_URL), params=payload)
-        result = json.loads(resp.text)
-        if not result['response']:
-            break
-        for campaign in result['response']:
-            for member in campaign['team_members']:
-                if not only_mine or member['account_id'] == CONFIGS['account_id']:
-                    yield campaign
-                    break
+    def _column(self, name):
+        column = self._columns()[name]
+        np = _numpy()
+        if not np:
+            return column
+        dtype = np.float64 if column.typecode == 'd' else np.int_
+        if not len(column):
+            return np.array([], dtype=dtype)
+        # A view of the array; it's only valid until the array grows.
+        return np.frombuffer(column, dtype=dtype)
 
+    def _columns(self):
+        if self.columns is None:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            rows = self.state.get('stats_rows', 0)
+            columns = {}
+            for name, typecode in self.COLUMNS:
+                column = columns[name] = array.array(typecode)
+                path = os.path.join(self.path, name)
+                if os.path.exists(path):
+                    with open(path, 'rb') as f:
+                        try:
+                            column.fromfile(f, rows)
+                        except EOFError:
+                            logging.warn("%s is missing some rows.", path)
+            rows = min(len(column) for column in columns.values())
+            for name, column in columns.items():
+                del column[rows:]
+                # Drop the rows of an incomplete commit
+                with open(os.path.join(self.path, name), 'ab') as f:
+                    f.truncate(rows * column.itemsize)
+            self.columns = columns
+            self.saved = rows
+            self.labels = dict(self.state.get('stats_perks') or {})
+        return self.columns
 
-def get_current_account():
-    payload = {'api_token': CONFIGS['api_key'],
-               'access_token': CONFIGS['access_token']
-               }
-    resp = requests.get('{base}/me.json'.format(base=BASE_URL), params=payload)
-    result = json.loads(resp.text)
-    return result['response']
 
+class AccountCache(object):
+    """Bounded LRU cache of Indiegogo accounts whose entries expire after `ttl`.
 
-def get_account_info(ident):
-    payload = {'api_token': CONFIGS['api_key'],
-               'access_token': CONFIGS['access_token']
-               }
-    url = '{base}/accounts/{ident}.json'.format(base=BASE_URL, ident=ident)
-    resp = requests.get(url, params=payload)
-    result = json.loads(resp.text)
-    return result['response']
+    Concurrent lookups of the same account share one request. The cached
+    accounts are kept in a state store so they survive restarts.
+    """
 
+    def __init__(self, store, size=1000, ttl=86400, workers=4):
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+        self.workers = workers
+        self.entries = collections.OrderedDict()
+        for key, entry in sorted(store.items(), key=lambda item: item[1]['ts']):
+            self.entries[key] = entry
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def get(self, ident):
+        key = str(ident)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry['ts'] + self.ttl > time.time():
+                # Move it to the most recently used end
+                self.entries[key] = entry
+                return entry['account']
+            lookup = self.inflight.get(key)
+            owner = lookup is None
+            if owner:
+                lookup = self.inflight[key] = {'done': threading.Event()}
+        if not owner:
+            lookup['done'].wait()
+            if 'account' not in lookup:
+                raise Exception("Failed to look up account {}.".format(ident))
+            return lookup['account']
+        try:
+            lookup['account'] = get_account_info(ident)
+            self._add(key, lookup['account'])
+            return lookup['account']
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            lookup['done'].set()
+
+    def prefetch(self, idents):
+        """Look up the accounts in parallel with up to `workers` requests at once.
+        """
+        idents = list(set(idents))
+        for i in range(0, len(idents), self.workers):
+            running = [_run_in_thread(self.get, ident) for ident in idents[i:i + self.workers]]
+            for thread, _ in running:
+                thread.join()
+
+    def _add(self, key, account):
+        entry = {'ts': time.time(), 'account': account}
+        with self.lock:
+            self.entries[key] = entry
+            self.store.set(key, entry)
+            while len(self.entries) > self.size:
+                evicted, _ = self.entries.popitem(last=False)
+                self.store.delete(evicted)
+
+
+def _accounts():
+    global ACCOUNTS
+    with ACCOUNTS_LOCK:
+        if ACCOUNTS is None:
+            ACCOUNTS = AccountCache(_state(_own_namespace('accounts')),
+                                    size=CONFIGS.get('account_cache_size', 1000),
+                                    ttl=CONFIGS.get('account_cache_ttl', 86400),
+                                    workers=CONFIGS.get('account_workers', 4))
+    return ACCOUNTS
+
+
+def check_now(campaign=None, parallel=None, names=None):
+    """Run the checks of the campaign once (all of them unless names are given).
+
+    In parallel mode, the API calls of every check are made concurrently and
+    the results are applied (state updates & notifications) one by one in the
+    same order as the sequential mode. A check whose fetch takes longer than
+    `check_timeout` seconds is skipped for this cycle: its fetch stops at its
+    next API call, and isn't started again until then.
+
+    Return whether each check found anything new.
+    """
+    if campaign is None:
+        campaign = Campaign(CONFIGS['campaign_id'])
+        campaign.load()
+    if parallel is None:
+        parallel = CONFIGS.get('parallel_checks', False)
+    checks = [check for check in CHECKS if names is None or check[0] in names]
+    if parallel:
+        results = _check_in_parallel(campaign, checks)
+    else:
+        results = _check_sequentially(campaign, checks)
+    for post in (_flush_bursts, _post_digest):
+        try:
+            post(campaign)
+        except KeyboardInterrupt:
+            raise
+        except:
+            logging.exception("Failed to post the digests.")
+    # Persist the state changes of the whole cycle at once
+    _commit(campaign)
+    return results
+
+
+def _commit(campaign):
+    # The events and the queued notifications go first so that a crash in
+    # between can only repeat them. Stores nobody has touched yet aren't
+    # loaded just for this.
+    if EVENTS is not None:
+        EVENTS.commit()
+    if DISPATCHER is not None:
+        DISPATCHER.outbox.commit()
+    # The rows go before the state that counts them
+    campaign.stats.commit()
+    campaign.bursts.commit()
+    campaign.state.commit()
+    if ACCOUNTS is not None:
+        ACCOUNTS.store.commit()
+
+
+def _check_sequentially(campaign, checks):
+    results = {}
+    for name, fetch, apply_ in checks:
+        results[name] = False
+        try:
+            results[name] = apply_(campaign, fetch(campaign))
+        except KeyboardInterrupt:
+            raise
+        except:
+            logging.exception("Failed to check %s.", name)
+    return results
+
+
+def _check_in_parallel(campaign, checks):
+    results = {}
+    deadline = time.time() + CONFIGS.get('check_timeout', 30)
+    running = []
+    for name, fetch, apply_ in checks:
+        results[name] = False
+        previous = campaign.fetching.get(name)
+        if previous is not None and previous.is_alive():
+            # A fetch that timed out stops at its next API call
+            logging.warn("Still fetching %s since the last cycle.", name)
+            continue
+        thread, box = _run_in_thread(_fetch_by, deadline, fetch, campaign)
+        campaign.fetching[name] = thread
+        running.append((name, apply_, thread, box))
+    for name, apply_, thread, box in running:
+        thread.join(max(0, deadline - time.time()))
+        if thread.is_alive():
+            logging.warn("Timed out checking %s.", name)
+            continue
+        if 'error' in box:
+            logging.error("Failed to check %s.", name, exc_info=box['error'])
+            continue
+        try:
+            results[name] = apply_(campaign, box['result'])
+        except KeyboardInterrupt:
+            raise
+        except:
+            logging.exception("Failed to check %s.", name)
+    return results
 
-def check_now():
-    try:
-        _check_comments()
-    except KeyboardInterrupt:
-        raise
-    except:
-        logging.exception("Failed to check comments.")
-    try:
-        _check_contribs()
-    except KeyboardInterrupt:
-        raise
-    except:
-        logging.exception("Failed to check contributions.")
-    try:
-        _check_campaign_status()
-    except KeyboardInterrupt:
-        raise
-    except:
-        logging.exception("Failed to check campaign status.")
-    try:
-        _check_perks_status()
-    except KeyboardInterrupt:
-        raise
-    except:
-        logging.exception("Failed to check perks status.")
+
+def _fetch_by(deadline, fetch, campaign):
+    API_CALLS.deadline = deadline
+    return fetch(campaign)
+
+
+def _fetch_unless(cancelled, fetch):
+    API_CALLS.cancelled = cancelled
+    return fetch()
+
+
+def _run_in_thread(func, *args):
+    box = {}
+    # e.g. the pages fetched ahead share the deadline of their check
+    deadline = getattr(API_CALLS, 'deadline', None)
+    cancelled = getattr(API_CALLS, 'cancelled', None)
+
+    def target():
+        API_CALLS.deadline = deadline
+        API_CALLS.cancelled = cancelled
+        try:
+            box['result'] = func(*args)
+        except:
+            box['error'] = sys.exc_info()
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread, box
 
 
 def write_to_slack(pretext, text, color, fields=None):
     """Write the text to the Slack channel.
+
+    The message is queued and delivered in the background.
     """
     if 'slack_url' not in CONFIGS or not CONFIGS['slack_url']:
         logging.info("Slack URL not configured.")
@@ -205,71 +1780,700 @@ def write_to_slack(pretext, text, color, fields=None):
         'fields': fields,
         'parse': 'full'
     }
-    try:
-        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        requests.post(CONFIGS['slack_url'], data=json.dumps(payload), headers=headers)
-    except:
-        logging.info("Failed to write to slack.", exc_info=True)
+    _dispatcher().put('slack', payload)
 
 
 def notify_ifttt(event, text, link, image):
     """Make a HTTP request to the IFTTT Maker channel.
+
+    The request is queued and made in the background.
     """
     if 'ifttt_maker_key' not in CONFIGS:
         logging.info("IFTTT not configured.")
         return
     payload = {
+        'event': event,
         'value1': text,
         'value2': link,
         'value3': image
     }
-    url = 'https://maker.ifttt.com/trigger/{event}/with/key/{key}'.format(
-        event=event,
+    _dispatcher().put('ifttt', payload)
+
+
+def _post_to_slack(payloads):
+    if len(payloads) == 1:
+        payload = payloads[0]
+    else:
+        # Coalesce the messages into one post
+        payload = {'attachments': payloads}
+    headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+    resp = _http().post(CONFIGS['slack_url'], data=json.dumps(payload), headers=headers)
+    _raise_for_status(resp, _dispatcher().limits['slack'])
+
+
+def _post_to_ifttt(payloads):
+    payload = dict(payloads[0])
+    url = IFTTT_URL.format(
+        event=payload.pop('event'),
         key=CONFIGS['ifttt_maker_key'])
-    try:
-        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        requests.post(url, data=json.dumps(payload), headers=headers)
-    except:
-        logging.info("Failed to notify IFTTT.", exc_info=True)
+    headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+    resp = _http().post(url, data=json.dumps(payload), headers=headers)
+    _raise_for_status(resp, _dispatcher().limits['ifttt'])
+
+
+class Dispatcher(object):
+    """Deliver Slack and IFTTT notifications in the background.
+
+    Notifications stay in the outbox store until they are delivered, so the
+    undelivered ones are sent again after a restart. Failed ones are retried
+    with a backoff of up to `max_backoff` seconds, and given up on once they
+    are `expire_after` seconds old. Each destination has its own rate limit,
+    and Slack messages that pile up are coalesced into posts with up to
+    `slack_batch` attachments. Deliveries are committed every
+    `commit_interval` seconds rather than one by one.
+    """
+
+    def __init__(self, outbox, slack_batch=20, ifttt_workers=4,
+                 slack_rate_limit=1, ifttt_rate_limit=0, max_backoff=300,
+                 expire_after=86400, commit_interval=1):
+        self.outbox = outbox
+        self.slack_batch = slack_batch
+        self.ifttt_workers = ifttt_workers
+        self.max_backoff = max_backoff
+        self.expire_after = expire_after
+        self.commit_interval = commit_interval
+        self.retries = []
+        self.retries_cond = threading.Condition()
+        self.queues = {'slack': Queue.Queue(), 'ifttt': Queue.Queue()}
+        self.limits = {'slack': TokenBucket(slack_rate_limit),
+                       'ifttt': TokenBucket(ifttt_rate_limit)}
+        self.posts = {'slack': _post_to_slack, 'ifttt': _post_to_ifttt}
+        self.seq = itertools.count(max([int(key) for key, _ in outbox.items()] or [0]) + 1)
+        for dest, queue in self.queues.iteritems():
+            METRICS.gauge('igg_notification_queue_depth', queue.qsize, dest=dest)
+
+    def start(self):
+        # Resend what wasn't delivered before the restart
+        for _, item in sorted(self.outbox.items()):
+            self.queues[item['dest']].put(item)
+        self._spawn(self._work, 'slack', self.slack_batch)
+        for _ in range(self.ifttt_workers):
+            self._spawn(self._work, 'ifttt', 1)
+        self._spawn(self._requeue)
+        self._spawn(self._commit_periodically)
+
+    def put(self, dest, payload):
+        item = {'id': '{:020d}'.format(next(self.seq)),
+                'dest': dest,
+                'payload': payload,
+                'attempts': 0,
+                'queued_at': time.time()}
+        # It's made durable with the state of the cycle.
+        self.outbox.set(item['id'], item)
+        self.queues[dest].put(item)
+
+    def flush(self, timeout=10):
+        """Wait until the outbox is empty.
+        """
+        self.outbox.commit()
+        deadline = time.time() + timeout
+        while self.outbox.items() and time.time() < deadline:
+            time.sleep(0.1)
+        self.outbox.commit()
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _work(self, dest, batch):
+        queue = self.queues[dest]
+        while True:
+            items = [queue.get()]
+            while len(items) < batch:
+                try:
+                    items.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            self.limits[dest].acquire()
+            started = time.time()
+            try:
+                self.posts[dest]([item['payload'] for item in items])
+            except:
+                logging.info("Failed to notify %s.", dest, exc_info=True)
+                METRICS.inc('igg_notification_failures_total', dest=dest)
+                for item in items:
+                    self._retry(item)
+            else:
+                now = time.time()
+                METRICS.observe('igg_request_seconds', now - started, endpoint=dest)
+                for item in items:
+                    METRICS.observe('igg_notification_delivery_seconds', now - item['queued_at'], dest=dest)
+                    self.outbox.delete(item['id'])
+
+    def _retry(self, item):
+        item['attempts'] += 1
+        if time.time() - item['queued_at'] >= self.expire_after:
+            logging.warn("Giving up notifying %s: %s", item['dest'], item['payload'])
+            self.outbox.delete(item['id'])
+            return
+        self.outbox.set(item['id'], item)
+        due = time.time() + min(self.max_backoff, 2 ** item['attempts'])
+        with self.retries_cond:
+            heapq.heappush(self.retries, (due, item['id'], item))
+            self.retries_cond.notify()
+
+    def _requeue(self):
+        while True:
+            with self.retries_cond:
+                while not self.retries or self.retries[0][0] > time.time():
+                    wait = self.retries and self.retries[0][0] - time.time() or 1
+                    self.retries_cond.wait(min(1, max(0, wait)))
+                _, _, item = heapq.heappop(self.retries)
+            self.queues[item['dest']].put(item)
+
+    def _commit_periodically(self):
+        # The deliveries and retries since the last time
+        while True:
+            time.sleep(self.commit_interval)
+            try:
+                self.outbox.commit()
+            except:
+                logging.exception("Failed to commit the outbox.")
+
+
+def _dispatcher():
+    global DISPATCHER
+    with DISPATCHER_LOCK:
+        if DISPATCHER is None:
+            DISPATCHER = Dispatcher(_state(_own_namespace('outbox')),
+                                    slack_batch=CONFIGS.get('slack_batch', 20),
+                                    ifttt_workers=CONFIGS.get('ifttt_workers', 4),
+                                    slack_rate_limit=CONFIGS.get('slack_rate_limit', 1),
+                                    ifttt_rate_limit=CONFIGS.get('ifttt_rate_limit', 0),
+                                    max_backoff=CONFIGS.get('notify_max_backoff', 300),
+                                    expire_after=CONFIGS.get('notify_expire_after', 86400))
+            DISPATCHER.start()
+    return DISPATCHER
+
+
+class Campaign(object):
+    """A monitored campaign with its own state namespace.
+    """
+
+    def __init__(self, ident, update_interval=None, reload=False, sync_existing=False):
+        self.ident = ident
+        self.update_interval = update_interval or CONFIGS.get('update_interval', 60)
+        self.sync_existing = sync_existing
+        namespace = _campaign_namespace(ident)
+        self.state = _state(namespace, reload)
+        if ident == CONFIGS.get('campaign_id') and not self.state.get('default_migrated'):
+            with _exclusive():
+                _migrate_default_state(self.state, namespace)
+        self.stats = ContribStats(os.path.join(STATE_DIR, namespace + '.stats'), self.state)
+        self.slug = None
+        self.preview_url = None
+        self.thumbnail_image_url = None
+        self.bursts = Coalescer(self.state,
+                                window=CONFIGS.get('notify_window', 0),
+                                top=CONFIGS.get('notify_top', 5))
+        self.perks = PerkIndex(self.state, ident,
+                               warn_claims=CONFIGS.get('perk_warn_claims', 10),
+                               warn_percent=CONFIGS.get('perk_warn_percent'))
+        self.min_interval = CONFIGS.get('min_update_interval', max(5, self.update_interval / 4.0))
+        self.max_interval = CONFIGS.get('max_update_interval', self.update_interval * 8)
+        self.intervals = dict((name, self.update_interval) for name, _, _ in CHECKS)
+        self.due = dict((name, 0) for name, _, _ in CHECKS)
+        # The thread of the last fetch of each check in parallel mode
+        self.fetching = {}
+
+    def due_checks(self):
+        now = time.time()
+        return [name for name, _, _ in CHECKS if self.due[name] <= now]
+
+    def next_due(self):
+        # A burst of notifications is sent even if no check is due by then.
+        return min(min(self.due.itervalues()), self.bursts.next_due(BURSTS) or float('inf'))
+
+    def reschedule(self, results):
+        """Adapt the interval of each check to its activity.
+
+        A check that found something new is made twice as often and an idle
+        one half as often, within the configured bounds. Intervals get some
+        jitter so that campaigns don't hit the API in lockstep.
+        """
+        jitter = CONFIGS.get('poll_jitter', 0.1)
+        now = time.time()
+        for name, active in results.iteritems():
+            interval = self.intervals[name] / 2.0 if active else self.intervals[name] * 2
+            interval = min(self.max_interval, max(self.min_interval, interval))
+            self.intervals[name] = interval
+            due = now + interval * random.uniform(1 - jitter, 1 + jitter)
+            # Don't bother while the API asks to retry later
+            self.due[name] = max(due, _api_budget().held_until)
+
+    def load(self, refresh=True):
+        """Retrieve the campaign information and initialize its state.
+
+        Without refresh, the information saved by the last load is used if
+        there is any.
+        """
+        campaign = None if refresh else self.state.get('info')
+        if campaign is None:
+            campaign = get_campaign_info(self.ident)
+            self.state.set('info', dict((key, campaign[key]) for key in
+                                        ('slug', 'preview_url', 'thumbnail_image_url',
+                                         'goal', 'collected_funds')))
+        self.slug = campaign['slug']
+        self.preview_url = campaign['preview_url']
+        self.thumbnail_image_url = campaign['thumbnail_image_url']
+        # Initialize cursors: a new campaign ignores the existing comments
+        # and contributions unless asked to sync them.
+        for key in ('comment', 'contrib'):
+            if self.state.get(key) is None:
+                Cursor(0 if self.sync_existing else time.time()).save(self.state, key)
+        # Insert markers for each campaign goal
+        goal = campaign['goal']
+        funds = campaign['collected_funds']
+        achieved = int(funds * 100 / goal)
+        for i in [30, 70, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000]:
+            # notify at each achievement
+            p = 'p' + str(i)
+            marker = self.state.get(p)
+            if not marker and achieved >= i:
+                self.state.set(p, time.time())
+        self.state.commit()
+
+
+def _campaign_namespace(ident):
+    return 'campaign-{ident}'.format(ident=ident)
+
+
+def _migrate_default_state(store, namespace):
+    """Import the state of the campaign set up by ftl() from the default
+    namespace, where older versions kept it outside worker mode.
+
+    If both have cursors, e.g. because the campaign was monitored in and out
+    of worker mode, the one further ahead wins so nothing is notified again.
+    """
+    fresh = store.get('stats_rows') is None
+    for key, value in _state().items():
+        if key in ('access_token', 'refresh_token', 'expires_at', 'account_id'):
+            continue
+        if key.startswith('stats_') and not fresh:
+            # The rows stay with the stats they count
+            continue
+        current = store.get(key)
+        if current is None:
+            store.set(key, value)
+        elif key in ('comment', 'contrib') and isinstance(current, dict) and isinstance(value, dict):
+            store.set(key, {'ts': max(current['ts'], value['ts']),
+                            'ids': current['ids'] + [ident for ident in value['ids'] if ident not in current['ids']]})
+    stats = os.path.join(STATE_DIR, 'default.stats')
+    if fresh and os.path.isdir(stats) and not os.path.exists(os.path.join(STATE_DIR, namespace + '.stats')):
+        import shutil
+        shutil.copytree(stats, os.path.join(STATE_DIR, namespace + '.stats'))
+    store.set('default_migrated', True)
+    store.commit()
+
+
+class Monitor(object):
+    """Watch many campaigns from one process.
+
+    Campaigns are kept in a heap ordered by when their next check is due. A
+    small pool of worker threads runs the due checks, so a slow campaign
+    doesn't hold back the others and no campaign is ever checked twice at
+    the same time. With leases, a campaign is only checked while its lease
+    is held.
+    """
+
+    def __init__(self, workers=4, leases=None):
+        self.workers = workers
+        self.leases = leases
+        self.queue = []
+        self.running = set()
+        self.stopped = threading.Event()
+        self.cond = threading.Condition()
+        self.seq = itertools.count()
+
+    def remove(self, campaign):
+        """Stop checking the campaign and return whether it was done.
+
+        A campaign being checked isn't removed.
+        """
+        with self.cond:
+            if campaign.ident in self.running:
+                return False
+            self.queue = [item for item in self.queue if item[2] is not campaign]
+            heapq.heapify(self.queue)
+            if self.leases is not None:
+                self.leases.forget(campaign.ident)
+            return True
+
+    def stop(self):
+        """Start no more checks and wait until those running are done.
+        """
+        self.stopped.set()
+        with self.cond:
+            while self.running:
+                # Wake up every second to stay responsive to CTRL-c
+                self.cond.wait(1)
+
+    def add(self, campaign, due=None):
+        with self.cond:
+            heapq.heappush(self.queue, (due or time.time(), next(self.seq), campaign))
+            self.cond.notify()
+
+    def run(self):
+        pending = Queue.Queue()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(pending,))
+            thread.daemon = True
+            thread.start()
+        while True:
+            with self.cond:
+                while not self.queue or self.queue[0][0] > time.time():
+                    # Wake up at least every second to stay responsive to CTRL-c
+                    wait = self.queue and self.queue[0][0] - time.time() or 1
+                    self.cond.wait(min(1, max(0, wait)))
+                _, _, campaign = heapq.heappop(self.queue)
+            pending.put(campaign)
+
+    def _work(self, pending):
+        while True:
+            campaign = pending.get()
+            with self.cond:
+                if self.stopped.is_set():
+                    continue
+                if self.leases is not None and not self.leases.holds(campaign.ident):
+                    logging.warn("Not checking campaign %s without its lease.", campaign.ident)
+                    continue
+                self.running.add(campaign.ident)
+            try:
+                self._check(campaign)
+            finally:
+                with self.cond:
+                    self.running.discard(campaign.ident)
+                    self.cond.notify_all()
+            if self.leases is None or self.leases.holds(campaign.ident):
+                self.add(campaign, campaign.next_due())
+
+    def _check(self, campaign):
+        names = campaign.due_checks()
+        results = dict((name, False) for name in names)
+        started = time.time()
+        try:
+            if campaign.slug is None:
+                # It failed to load so far
+                campaign.load()
+            results = check_now(campaign, names=names)
+        except:
+            logging.exception("Failed to check campaign %s.", campaign.ident)
+        elapsed = time.time() - started
+        METRICS.observe('igg_cycle_seconds', elapsed)
+        if names and elapsed > min(campaign.intervals[name] for name in names):
+            # It took longer than the checks were meant to wait until the next time.
+            METRICS.inc('igg_cycle_overruns_total')
+        campaign.reschedule(results)
+
+
+class Leases(object):
+    """Leases of the campaigns shared by worker processes in an SQLite file.
+
+    Every worker heartbeats through balance(), which renews its leases and
+    takes free or expired ones up to its fair share of the campaigns. A
+    lease not renewed for `ttl` seconds, e.g. because its worker died, is
+    free for the others to take. A worker holding more than its share
+    (e.g. after another one joined) gets the surplus to release.
+    """
+
+    def __init__(self, path, worker, ttl=60):
+        import sqlite3
+        self.worker = worker
+        self.ttl = ttl
+        self.held = {}
+        self.lock = threading.Lock()
+        self.db_lock = threading.RLock()
+        self.db = sqlite3.connect(path, timeout=max(60, ttl), isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS leases '
+                        '(campaign INTEGER PRIMARY KEY, worker TEXT, expires REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS workers '
+                        '(worker TEXT PRIMARY KEY, heartbeat REAL)')
+
+    def balance(self, campaigns):
+        """Renew the leases and return the campaigns acquired and the surplus.
+        """
+        with self.exclusive():
+            now = time.time()
+            self.db.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (self.worker, now))
+            self.db.execute('DELETE FROM workers WHERE heartbeat < ?', (now - self.ttl,))
+            workers = self.db.execute('SELECT COUNT(*) FROM workers').fetchone()[0]
+            self.db.execute('UPDATE leases SET expires = ? WHERE worker = ?', (now + self.ttl, self.worker))
+            owners = dict(self.db.execute('SELECT campaign, worker FROM leases WHERE expires >= ?', (now,)))
+            mine = [ident for ident in campaigns if owners.get(ident) == self.worker]
+            share = -(-len(campaigns) // workers)
+            free = [ident for ident in campaigns if ident not in owners][:max(0, share - len(mine))]
+            for ident in free:
+                self.db.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)',
+                                (ident, self.worker, now + self.ttl))
+            with self.lock:
+                # The leases left by a previous run of this worker are taken
+                # up again, and those taken over by others (e.g. while this
+                # process was stopped) are lost.
+                acquired = [ident for ident in mine if ident not in self.held] + free
+                self.held = dict((ident, now + self.ttl) for ident in mine + free)
+        return acquired, mine[share:]
+
+    def holds(self, campaign):
+        """Return whether the lease of the campaign is held for a while still.
+        """
+        with self.lock:
+            return self.held.get(campaign, 0) - time.time() > self.ttl / 3.0
+
+    def forget(self, campaign):
+        with self.lock:
+            self.held.pop(campaign, None)
+
+    def workers(self):
+        """Return the IDs of the workers alive.
+        """
+        with self.db_lock:
+            return set(worker for worker, in self.db.execute('SELECT worker FROM workers WHERE heartbeat >= ?',
+                                                             (time.time() - self.ttl,)))
+
+    def release(self, campaigns):
+        for ident in campaigns:
+            self.forget(ident)
+        with self.exclusive():
+            self.db.executemany('DELETE FROM leases WHERE campaign = ? AND worker = ?',
+                                [(ident, self.worker) for ident in campaigns])
+
+    def close(self):
+        """Release all the leases and leave.
+        """
+        with self.lock:
+            held = list(self.held)
+        self.release(held)
+        with self.exclusive():
+            self.db.execute('DELETE FROM workers WHERE worker = ?', (self.worker,))
+        self.db.close()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """Hold the lock shared by all the worker processes.
+        """
+        with self.db_lock:
+            self.db.execute('BEGIN EXCLUSIVE')
+            try:
+                yield
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            else:
+                self.db.execute('COMMIT')
+
+
+@contextlib.contextmanager
+def _exclusive():
+    """Hold the lock shared by the worker processes, if this is one of them.
+    """
+    if LEASES is None:
+        yield
+    else:
+        with LEASES.exclusive():
+            yield
+
+
+def _own_namespace(namespace):
+    """Return the namespace of this process (each worker has its own).
+    """
+    if LEASES is None:
+        return namespace
+    return '{}-{}'.format(namespace, LEASES.worker)
+
+
+def _campaign_configs():
+    """Return the Campaign() options of each campaign to monitor by its ID.
+
+    `campaigns` in the configurations is a list of campaign IDs or objects
+    like {"campaign_id": 123, "update_interval": 300, "sync_existing": true}.
+    Without it, only the campaign set up by ftl() is monitored.
+    """
+    configs = collections.OrderedDict()
+    for entry in CONFIGS.get('campaigns') or [CONFIGS['campaign_id']]:
+        if not isinstance(entry, dict):
+            entry = {'campaign_id': entry}
+        configs[entry['campaign_id']] = {'update_interval': entry.get('update_interval'),
+                                         'sync_existing': entry.get('sync_existing', False)}
+    return configs
+
+
+def _configured_campaigns():
+    """Return the campaigns to monitor.
+    """
+    return [Campaign(ident, **options) for ident, options in _campaign_configs().items()]
 
 
 def start():
-    """Start monitoring the Indiegogo campaign.
-    """
-    # Retrieve the current campaign information
-    campaign = get_campaign_info()
-    CONFIGS['slug'] = campaign['slug']
-    CONFIGS['campaign_id'] = campaign['id']
-    CONFIGS['campaign_preview_url'] = campaign['preview_url']
-    CONFIGS['campaign_thumbnail_image_url'] = campaign['thumbnail_image_url']
-    # Initialize timestamps
-    last_comment_ts = DB.search(where('type') == 'comment')
-    if not last_comment_ts:
-        DB.insert({'ts': 0, 'type': 'comment'})
-    last_contrib_ts = DB.search(where('type') == 'contrib')
-    if not last_contrib_ts:
-        DB.insert({'ts': 0, 'type': 'contrib'})
-    # Insert markers for each campaign goal
-    goal = campaign['goal']
-    funds = campaign['collected_funds']
-    achieved = int(funds * 100 / goal)
-    for i in [30, 70, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000]:
-        # notify at each achievement
-        p = 'p' + str(i)
-        marker = DB.search(where('type') == p)
-        if not marker and achieved >= i:
-            DB.insert({'ts': time.time(), 'type': p})
-    update_interval = CONFIGS['update_interval']
+    """Start monitoring the Indiegogo campaigns.
+    """
+    if CONFIGS.get('metrics_port'):
+        serve_metrics(CONFIGS['metrics_port'])
+    if CONFIGS.get('metrics_log_interval', 300):
+        log_metrics(CONFIGS.get('metrics_log_interval', 300))
+    monitor = Monitor(workers=CONFIGS.get('monitor_workers', 4))
+    for campaign in _configured_campaigns():
+        # Retrieve the current campaign information
+        try:
+            campaign.load()
+        except:
+            # The monitor loads it again before its first check
+            logging.exception("Failed to load campaign %s.", campaign.ident)
+            monitor.add(campaign, time.time() + campaign.update_interval)
+            continue
+        monitor.add(campaign)
     print "Start monitoring (CTRL-c to stop)..."
     try:
-        while True:
-            check_now()
-            time.sleep(update_interval)
+        monitor.run()
     except:
         pass
+    _dispatcher().flush()
     print "Monitoring stopped."
 
 
+def run_worker(worker):
+    """Monitor a share of the campaigns as one of many worker processes.
+
+    Workers, on this host or others sharing its state directory, split the
+    campaigns between them with leases and take over those of a worker
+    that stops. Each campaign is checked by one worker at a time.
+    """
+    global LEASES
+    if not os.path.isdir(STATE_DIR):
+        os.makedirs(STATE_DIR)
+    LEASES = Leases(os.path.join(STATE_DIR, 'leases.db'), worker, ttl=CONFIGS.get('lease_ttl', 60))
+    if CONFIGS.get('metrics_port'):
+        serve_metrics(CONFIGS['metrics_port'])
+    if CONFIGS.get('metrics_log_interval', 300):
+        log_metrics(CONFIGS.get('metrics_log_interval', 300))
+    monitor = Monitor(workers=CONFIGS.get('monitor_workers', 4), leases=LEASES)
+    thread = threading.Thread(target=_balance, args=(monitor, _campaign_configs()))
+    thread.daemon = True
+    thread.start()
+    print "Worker {} started (CTRL-c to stop)...".format(worker)
+    try:
+        monitor.run()
+    except:
+        pass
+    # The leases are held until the last check is done, so that no other
+    # worker checks its campaign at the same time.
+    monitor.stop()
+    thread.join()
+    _dispatcher().flush()
+    # Let the other workers take over right away
+    LEASES.close()
+    print "Worker {} stopped.".format(worker)
+
+
+def _balance(monitor, configs):
+    owned = {}
+    while not monitor.stopped.is_set():
+        try:
+            acquired, surplus = LEASES.balance(list(configs))
+            for ident in acquired:
+                try:
+                    # Another worker may have checked it since it was last loaded
+                    campaign = Campaign(ident, reload=True, **configs[ident])
+                    campaign.load()
+                except:
+                    logging.exception("Failed to load campaign %s.", ident)
+                    LEASES.release([ident])
+                    continue
+                logging.info("Acquired campaign %s.", ident)
+                owned[ident] = campaign
+                monitor.add(campaign)
+            released = [ident for ident in surplus if monitor.remove(owned[ident])]
+            LEASES.release(released)
+            for ident in owned.keys():
+                if ident in released or (not LEASES.holds(ident) and monitor.remove(owned[ident])):
+                    logging.info("Released campaign %s.", ident)
+                    del owned[ident]
+            METRICS.gauge('igg_leases_held', len(owned))
+            _adopt_outboxes()
+        except:
+            logging.exception("Failed to balance the campaigns.")
+        monitor.stopped.wait(LEASES.ttl / 3.0)
+
+
+def _adopt_outboxes():
+    """Deliver the notifications left in the outboxes of the workers that are gone.
+    """
+    with LEASES.exclusive():
+        alive = LEASES.workers() | set([LEASES.worker])
+        for name in os.listdir(STATE_DIR):
+            if not name.startswith('outbox-') or not name.endswith('.journal'):
+                continue
+            worker = name[len('outbox-'):-len('.journal')]
+            if worker in alive:
+                continue
+            path = os.path.join(STATE_DIR, name)
+            items = sorted(StateStore(path).items())
+            for _, item in items:
+                _dispatcher().put(item['dest'], item['payload'])
+            # Made durable here before the other outbox is gone
+            _dispatcher().outbox.commit()
+            os.remove(path)
+            if items:
+                logging.info("Took over %d notifications of worker %s.", len(items), worker)
+
+
+def run_once(names=None, report=False, auth_time=None):
+    """Check every configured campaign once, e.g. from cron.
+
+    Only the given checks are run (all by default) and only the state they
+    need is loaded. A campaign that fails doesn't keep the others from
+    being checked. With report, the import and authentication times and the
+    latency of the first cycle are printed.
+    """
+    if os.path.exists(os.path.join(STATE_DIR, _own_namespace('outbox') + '.journal')):
+        # Deliver what the previous runs left in the outbox
+        _dispatcher()
+    results = {}
+    try:
+        for campaign in _configured_campaigns():
+            loaded = time.time()
+            try:
+                campaign.load(refresh=False)
+                checked = time.time()
+                results[campaign.ident] = check_now(campaign, names=names)
+            except KeyboardInterrupt:
+                raise
+            except:
+                logging.exception("Failed to check campaign %s.", campaign.ident)
+                continue
+            if report:
+                print "Campaign {}: load {:.3f}s, first cycle {:.3f}s".format(
+                    campaign.ident, checked - loaded, time.time() - checked)
+    finally:
+        if DISPATCHER is not None:
+            DISPATCHER.flush()
+    if report:
+        print "Import {:.3f}s, auth {}, total {:.3f}s".format(
+            IMPORTED - IMPORT_STARTED,
+            '{:.3f}s'.format(auth_time) if auth_time is not None else 'n/a',
+            time.time() - IMPORT_STARTED)
+    return results
+
+
+def _load_configs(path='config.json'):
+    try:
+        with open(path, 'r') as f:
+            CONFIGS.update(json.loads(f.read()))
+    except:
+        pass
+
+
 def ftl():
     """Initializer.
     """
@@ -311,10 +2515,10 @@ def ftl():
         while not found:
             for campaign in search_campaigns(terms, max_page=10, only_mine=only_mine):
                 print
-                print u'[{title}]'.format(title=campaign['title'])
+                print u'[{title}]'.format(title=campaign.title)
                 yes = _prompt_yes_no("Select this one", default_yes=False)
                 if yes:
-                    campaign_id = campaign['id']
+                    campaign_id = campaign.id
                     found = True
                     break
             if not found:
@@ -330,126 +2534,304 @@ def ftl():
     print
     print "Do you want to sync all comments and contributions from the beginning? If no, it will ignore existing ones and only start keeping track of new ones from now on. Be warned if you choose to sync and there are already a lot of comments and contributions!"
     yes = _prompt_yes_no("Do you want to sync existing comments and contributions", default_yes=False)
-    if not yes:
-        # Insert the current timestamp so that it would ignore the existing comments and contributions.
-        DB.insert({'ts': time.time(), 'type': 'comment'})
-        DB.insert({'ts': time.time(), 'type': 'contrib'})
+    state = _state(_campaign_namespace(campaign_id))
+    # Insert the current timestamp so that it would ignore the existing comments and contributions.
+    Cursor(0 if yes else time.time()).save(state, 'comment')
+    Cursor(0 if yes else time.time()).save(state, 'contrib')
+    # Nothing to import from older versions for a campaign set up now
+    state.set('default_migrated', True)
+    state.commit()
 
 
 def authenticate():
-    access_token = DB.search(where('type') == 'access_token')
-    if not access_token:
+    state = _state()
+    if not state.get('access_token'):
         ident = _prompt_required('Indiegogo ID (email): ', 'Please enter your Indiegogo ID (email): ')
+        import getpass
         password = getpass.getpass('Password: ')
-        output = subprocess.check_output('curl -ss -X POST -d grant_type=password -d credential_type=email -d email={email} -d password={password} https://auth.indiegogo.com/oauth/token'.format(email=ident, password=password), shell=True)
-        tokens = json.loads(output)
-        DB.insert({'value': tokens['access_token'], 'type': 'access_token'})
-        DB.insert({'value': tokens['refresh_token'], 'type': 'refresh_token'})
-        CONFIGS['access_token'] = tokens['access_token']
-        CONFIGS['refresh_token'] = tokens['refresh_token']
+        _tokens().login(ident, password)
         print "Authentication successful."
-    else:
-        CONFIGS['access_token'] = access_token[0]['value']
-        refresh_token = DB.search(where('type') == 'refresh_token')
-        CONFIGS['refresh_token'] = refresh_token[0]['value']
-    me = get_current_account()
-    CONFIGS['account_id'] = me['id']
-
-
-def _check_comments():
-    last_comment_ts = DB.search(where('type') == 'comment')[0]['ts']
-    comments = [c for c in new_comments(last_comment_ts)]
-    if len(comments) > 0:
-        comment_ts = _convert_to_ts(comments[0]['created_at'])
-        if last_comment_ts != comment_ts:
-            DB.update({'ts': comment_ts}, where('type') == 'comment')
-        for comment in reversed(comments):
-            # notify in slack
-            write_to_slack('New comment',
-                           comment['text'].replace('\n', '\\n').replace('\r', ''),
-                           'warn')
-            # notify IFTTT:
-            #   value1 : comment text
-            #   value2 : direct link to the comment
-            #   value3 : avatar url of the commenter
-            notify_ifttt('igg-comments',
-                         comment['text'],
-                         _build_comments_url(comment['id']),
-                         comment['account']['avatar_url'])
-    else:
+    account_id = state.get('account_id')
+    if account_id is None:
+        account_id = get_current_account()['id']
+        state.set('account_id', account_id)
+        state.commit()
+    CONFIGS['account_id'] = account_id
+
+
+def _fetch_comments(campaign):
+    spool = Spool(Comment, CONFIGS.get('spool_chunk', 100))
+    for comment in new_comments(Cursor.load(campaign.state, 'comment'), campaign.ident):
+        spool.append(comment)
+    return spool
+
+
+def _apply_comments(campaign, spool):
+    if not len(spool):
         logging.info("No new comments.")
+        return
+    cursor = Cursor.load(campaign.state, 'comment')
+    for chunk in spool.chunks():
+        try:
+            for comment in chunk:
+                # Advanced and recorded first, so that an item whose
+                # notification fails is neither notified twice nor lost
+                cursor.advance(comment.ts, comment.id)
+                _emit(campaign, 'comment', comment._asdict(), comment.ts)
+                if campaign.bursts.admit('comments', comment.text[:100]):
+                    _notify_comment(campaign, comment)
+        finally:
+            # Checkpoint so that neither a crash nor a failure notifies the chunk again
+            cursor.save(campaign.state, 'comment')
+            _commit(campaign)
+        METRICS.inc('igg_items_total', len(chunk), feed='comments')
+    spool.close()
+    return True
 
 
-def _check_contribs():
-    last_contrib_ts = DB.search(where('type') == 'contrib')[0]['ts']
-    contribs = [c for c in new_contribs(last_contrib_ts)]
-    if len(contribs) > 0:
-        contrib_ts = _convert_to_ts(contribs[0]['created_at'])
-        if last_contrib_ts != contrib_ts:
-            DB.update({'ts': contrib_ts}, where('type') == 'contrib')
-        for contrib in reversed(contribs):
-            if not contrib['perk']:
-                # Contributed without selecting any perk
-                contrib['perk'] = {'label': 'No perk'}
-            contributor_name = \
-                contrib['by'] if 'contributor_name' not in contrib else contrib['contributor_name'],
-            # notify in slack
-            slack_fields = [
-                               {
-                                   'title': 'Name',
-                                   'value': contributor_name,
-                                   'short': False
-                               },
-                               {
-                                   'title': 'Value',
-                                   'value': '$' + str(contrib['amount']),
-                                   'short': False
-                               }
-                           ]
-            if 'referrer_id' in contrib:
-                referrer = get_account_info(contrib['referrer_id'])
-                slack_fields.append({
-                    'title': 'Referrer',
-                    'value': referrer['name'],
-                    'short': False
-                })
-            else:
-                referrer = None
-            write_to_slack('New contribution!',
-                           contrib['perk']['label'],
-                           'good',
-                           slack_fields
-                           )
-            # notify IFTTT:
-            #   value1 : perk text
-            #   value2 : direct link to the contributor
-            #   value3 : avatar url of the contributor
-            notify_ifttt('igg-contributions',
-                         u'{contrib} claimed by {who} for ${amount}{referrer}'.format(
-                             contrib=contrib['perk']['label'],
-                             who=contributor_name,
-                             amount=contrib['amount'],
-                             referrer=u'' if not referrer else u' referred by {}'.format(referrer['name'])
-                         ),
-                         _build_contrib_url(contrib['id']),
-                         contrib['avatar_url'])
-    else:
+def _notify_comment(campaign, comment):
+    # notify in slack
+    write_to_slack('New comment',
+                   comment.text.replace('\n', '\\n').replace('\r', ''),
+                   'warn')
+    # notify IFTTT:
+    #   value1 : comment text
+    #   value2 : direct link to the comment
+    #   value3 : avatar url of the commenter
+    notify_ifttt('igg-comments',
+                 comment.text,
+                 _build_comments_url(campaign, comment.id),
+                 comment.avatar_url)
+
+
+def _fetch_contribs(campaign):
+    spool = Spool(Contrib, CONFIGS.get('spool_chunk', 100))
+    referrers = set()
+    for contrib in new_contribs(Cursor.load(campaign.state, 'contrib'), campaign.ident):
+        spool.append(contrib)
+        if contrib.referrer_id is not None:
+            referrers.add(contrib.referrer_id)
+    # Look up all the referrers of the batch at once
+    _accounts().prefetch(referrers)
+    return spool
+
+
+def _apply_contribs(campaign, spool):
+    if not len(spool):
         logging.info("No new contributions yet.")
+        return
+    cursor = Cursor.load(campaign.state, 'contrib')
+    for chunk in spool.chunks():
+        try:
+            for contrib in chunk:
+                # Advanced and recorded first, so that an item whose
+                # notification fails is neither notified twice nor lost
+                cursor.advance(contrib.ts, contrib.id)
+                referrer = None
+                if contrib.referrer_id is not None:
+                    try:
+                        referrer = _accounts().get(contrib.referrer_id)
+                    except:
+                        # Notified without the referrer rather than not at all
+                        logging.warn("Failed to look up referrer %s.", contrib.referrer_id, exc_info=True)
+                event = contrib._asdict()
+                event['referrer_name'] = referrer and referrer['name']
+                _emit(campaign, 'contribution', event, contrib.ts)
+                campaign.stats.add(contrib)
+                if campaign.bursts.admit('contributions', u'{} for ${}'.format(contrib.name, contrib.amount),
+                                         contrib.amount, group=contrib.perk_label):
+                    _notify_contrib(campaign, contrib, referrer)
+        finally:
+            # Checkpoint so that neither a crash nor a failure notifies the chunk again
+            cursor.save(campaign.state, 'contrib')
+            _commit(campaign)
+        METRICS.inc('igg_items_total', len(chunk), feed='contributions')
+    spool.close()
+    return True
+
+
+def _notify_contrib(campaign, contrib, referrer):
+    # notify in slack
+    slack_fields = [
+                       {
+                           'title': 'Name',
+                           'value': contrib.name,
+                           'short': False
+                       },
+                       {
+                           'title': 'Value',
+                           'value': '$' + str(contrib.amount),
+                           'short': False
+                       }
+                   ]
+    if referrer:
+        slack_fields.append({
+            'title': 'Referrer',
+            'value': referrer['name'],
+            'short': False
+        })
+    write_to_slack('New contribution!',
+                   contrib.perk_label,
+                   'good',
+                   slack_fields
+                   )
+    # notify IFTTT:
+    #   value1 : perk text
+    #   value2 : direct link to the contributor
+    #   value3 : avatar url of the contributor
+    notify_ifttt('igg-contributions',
+                 u'{contrib} claimed by {who} for ${amount}{referrer}'.format(
+                     contrib=contrib.perk_label,
+                     who=contrib.name,
+                     amount=contrib.amount,
+                     referrer=u'' if not referrer else u' referred by {}'.format(referrer['name'])
+                 ),
+                 _build_contrib_url(campaign, contrib.id),
+                 contrib.avatar_url)
+
+
+# Notifications coalesced in bursts: (Slack pretext, IFTTT event, what they
+# are, what they are grouped by)
+BURSTS = {
+    'comments': ('New comments', 'igg-comments', 'comments', None),
+    'contributions': ('New contributions!', 'igg-contributions', 'contributions', 'Perks'),
+    'perks': ('Sold-out warnings.', 'igg-perks-status', 'sold-out warnings', None),
+}
+
+
+def _flush_bursts(campaign, now=None):
+    """Send a digest of each burst of notifications whose window ended.
+    """
+    now = now or time.time()
+    for kind, burst in campaign.bursts.due(BURSTS, now):
+        pretext, event, noun, grouped_by = BURSTS[kind]
+        text = u'{count} more {noun} in the last {duration}'.format(
+            count=burst['count'], noun=noun, duration=_format_duration(now - burst['opened']))
+        if burst['total']:
+            text += u' for ${:,}'.format(burst['total'])
+        fields = []
+        groups = campaign.bursts.top_groups(burst)
+        if groups:
+            fields.append({
+                'title': grouped_by,
+                'value': u'\n'.join(u'{}: {} for ${:,}'.format(group, count, total)
+                                    for group, count, total in groups),
+                'short': False
+            })
+        fields.append({
+            'title': 'Latest',
+            'value': u'\n'.join(reversed(burst['items'])),
+            'short': False
+        })
+        write_to_slack(pretext, text + '.', 'good', fields)
+        # notify IFTTT:
+        #   value1 : digest text
+        #   value2 : direct link to the campaign
+        #   value3 : thumbnail of the campaign
+        notify_ifttt(event, text + '.', campaign.preview_url, campaign.thumbnail_image_url)
+        METRICS.inc('igg_coalesced_total', burst['count'], kind=kind)
+
+
+def _post_digest(campaign, now=None):
+    """Post a summary of the contributions every `digest_interval` seconds.
+    """
+    interval = CONFIGS.get('digest_interval', 0)
+    if not interval:
+        return
+    now = now or time.time()
+    last = campaign.state.get('digest_at')
+    if last is None:
+        # The first period starts now
+        campaign.state.set('digest_at', now)
+        return
+    if now - last < interval:
+        return
+    stats = campaign.stats
+    count, total = stats.summary(last)
+    backers, funds = stats.summary()
+    top = CONFIGS.get('digest_top', 5)
+    perks = sorted(stats.by_perk(last).items(), key=lambda item: -item[1][1])[:top]
+    referrers = sorted(stats.by_referrer(last).items(), key=lambda item: -item[1][1])[:top]
+    hours = stats.by_hour(last)
+    fields = [
+                 {
+                     'title': 'Contributions',
+                     'value': u'{} for ${:,.0f} (${:,.2f} on average)'.format(
+                         count, total, total / count if count else 0),
+                     'short': False
+                 },
+                 {
+                     'title': 'Funding velocity',
+                     'value': u'${:,.2f} per hour'.format(total * 3600 / (now - last)),
+                     'short': False
+                 },
+                 {
+                     'title': 'All time',
+                     'value': u'{} for ${:,.0f} (${:,.2f} on average)'.format(
+                         backers, funds, funds / backers if backers else 0),
+                     'short': False
+                 }
+             ]
+    if perks:
+        fields.append({
+            'title': 'Top perks',
+            'value': u'\n'.join(u'{}: {} for ${:,.0f}'.format(stats.label(perk), c, t)
+                                for perk, (c, t) in perks),
+            'short': False
+        })
+    if referrers:
+        fields.append({
+            'title': 'Top referrers',
+            'value': u'\n'.join(u'{}: {} for ${:,.0f}'.format(_referrer_name(referrer), c, t)
+                                for referrer, (c, t) in referrers),
+            'short': False
+        })
+    if hours:
+        hour, (c, t) = max(hours.items(), key=lambda item: item[1][1])
+        fields.append({
+            'title': 'Busiest hour',
+            'value': u'{} ({} for ${:,.0f})'.format(time.strftime('%Y-%m-%d %H:00', time.localtime(hour)), c, t),
+            'short': False
+        })
+    write_to_slack('Contributions digest',
+                   u'{count} new contributions for ${total:,.0f} since {since}.'.format(
+                       count=count, total=total,
+                       since=time.strftime('%Y-%m-%d %H:%M', time.localtime(last))),
+                   'good',
+                   fields)
+    campaign.state.set('digest_at', now)
+
+
+def _referrer_name(ident):
+    try:
+        return _accounts().get(ident)['name']
+    except:
+        logging.warn("Failed to look up referrer %s.", ident, exc_info=True)
+        return unicode(ident)
+
 
+def _fetch_campaign_status(campaign):
+    return get_campaign_info(campaign.ident, if_changed=True)
 
-def _check_campaign_status():
-    campaign = get_campaign_info()
-    goal = campaign['goal']
-    funds = campaign['collected_funds']
+
+def _apply_campaign_status(campaign, fetched):
+    info, validators = fetched
+    if info is None:
+        logging.info("No campaign status changes.")
+        return
+    goal = info['goal']
+    funds = info['collected_funds']
     achieved = int(funds * 100 / goal)
+    _emit(campaign, 'campaign', {'goal': goal, 'collected_funds': funds, 'achieved': achieved})
     for i in [30, 70, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000]:
         # notify at each achievement
         p = 'p' + str(i)
-        marker = DB.search(where('type') == p)
+        marker = campaign.state.get(p)
         if not marker and achieved >= i:
-            DB.insert({'ts': time.time(), 'type': p})
+            campaign.state.set(p, time.time())
+            _emit(campaign, 'goal', {'goal': goal, 'collected_funds': funds, 'achieved': achieved, 'marker': i})
             msg = u'"{title}" reached {achieved}%: ${funds}'.format(
-                title=campaign['title'],
+                title=info['title'],
                 achieved=achieved,
                 funds=funds)
             # notify in slack
@@ -460,98 +2842,188 @@ def _check_campaign_status():
             #   value3 : thumbnail of the campaign
             notify_ifttt('igg-status',
                          msg,
-                         CONFIGS['campaign_preview_url'],
-                         CONFIGS['campaign_thumbnail_image_url'])
-            return
+                         campaign.preview_url,
+                         campaign.thumbnail_image_url)
+            # One at a time: the document is evaluated again next cycle for
+            # any other milestone it crossed.
+            break
+    else:
+        _keep_validators(validators)
+    return True
+
 
+def _fetch_perks_status(campaign):
+    return get_perks_info(campaign.ident, if_changed=True)
 
-def _check_perks_status():
-    perks = get_perks_info()
-    for perk in perks:
-        claimed = perk['number_claimed']
-        available = perk['number_available']
-        if available and claimed != available and claimed + 10 >= available:
-            p = 'soldout-' + str(perk['id'])
-            marker = DB.search(where('type') == p)
-            if not marker:
-                DB.insert({'ts': time.time(), 'type': p})
-                # notify that it's sold out!
-                write_to_slack('Sold-out warning.',
-                               perk['label'] + ' is almost sold out. @channel',
-                               'danger',
-                               [
-                                   {
-                                       'title': 'Claimed',
-                                       'value': perk['number_claimed'],
-                                       'short': False
-                                   },
-                                   {
-                                       'title': 'Availability',
-                                       'value': perk['number_available'],
-                                       'short': False
-                                   }
-                               ])
-                # notify IFTTT:
-                #   value1 : message
-                #   value2 : direct link to the campaign
-                #   value3 : thumbnail of the campaign
-                notify_ifttt('igg-perks-status',
-                             u'{perk} is almost sold out. - {claimed}/{available}'.format(perk=perk['label'],
-                                                                                         claimed=perk['number_claimed'],
-                                                                                         available=perk['number_available']),
-                             CONFIGS['campaign_preview_url'],
-                             CONFIGS['campaign_thumbnail_image_url'])
-        elif available and claimed >= available:
-            p = 'almost-' + str(perk['id'])
-            marker = DB.search(where('type') == p)
-            if not marker:
-                DB.insert({'ts': time.time(), 'type': p})
-                # notify that it's almost sold out!
-                write_to_slack('Sold-out warning.',
-                               perk['label'] + ' is sold out!! @channel',
-                               'danger',
-                               [
-                                   {
-                                       'title': 'Claimed',
-                                       'value': perk['number_claimed'],
-                                       'short': False
-                                   },
-                                   {
-                                       'title': 'Availability',
-                                       'value': perk['number_available'],
-                                       'short': False
-                                   }
-                               ])
-                # notify IFTTT:
-                #   value1 : message
-                #   value2 : direct link to the campaign
-                #   value3 : thumbnail of the campaign
-                notify_ifttt('igg-perks-status',
-                             u'{perk} is completely sold out. - {claimed}/{available}'.format(perk=perk['label'],
-                                                                                         claimed=perk['number_claimed'],
-                                                                                         available=perk['number_available']),
-                             CONFIGS['campaign_preview_url'],
-                             CONFIGS['campaign_thumbnail_image_url'])
+
+def _apply_perks_status(campaign, fetched):
+    perks, validators = fetched
+    if perks is None:
+        logging.info("No perks status changes.")
+        return
+    for kind, perk, entry in campaign.perks.update(perks):
+        _emit(campaign, 'perk' if kind == 'changed' else 'perk ' + kind,
+              {'id': perk['id'],
+               'label': perk['label'],
+               'number_claimed': perk['number_claimed'],
+               'number_available': perk['number_available'],
+               'claims_per_hour': PerkIndex.velocity(entry),
+               'sellout_eta': PerkIndex.eta(entry)})
+        if kind == 'changed':
+            continue
+        fields = [
+                     {
+                         'title': 'Claimed',
+                         'value': perk['number_claimed'],
+                         'short': False
+                     },
+                     {
+                         'title': 'Availability',
+                         'value': perk['number_available'],
+                         'short': False
+                     }
+                 ]
+        velocity = PerkIndex.velocity(entry)
+        eta = PerkIndex.eta(entry)
+        if velocity:
+            fields.append({
+                'title': 'Claims per hour',
+                'value': round(velocity, 1),
+                'short': False
+            })
+        if kind == 'sold out':
+            text = u'{perk} is completely sold out.'.format(perk=perk['label'])
+        elif eta is not None:
+            text = u'{perk} is almost sold out (sells out in about {eta}).'.format(perk=perk['label'],
+                                                                                eta=_format_duration(eta))
+        else:
+            text = u'{perk} is almost sold out.'.format(perk=perk['label'])
+        if not campaign.bursts.admit('perks', text):
+            continue
+        # notify that it's (almost) sold out!
+        write_to_slack('Sold-out warning.', text + ' @channel', 'danger', fields)
+        # notify IFTTT:
+        #   value1 : message
+        #   value2 : direct link to the campaign
+        #   value3 : thumbnail of the campaign
+        notify_ifttt('igg-perks-status',
+                     u'{text} - {claimed}/{available}'.format(text=text,
+                                                             claimed=perk['number_claimed'],
+                                                             available=perk['number_available']),
+                     campaign.preview_url,
+                     campaign.thumbnail_image_url)
+    _keep_validators(validators)
+    return True
+
+
+# (name, fetch, apply) of each check in the order they are applied
+CHECKS = [
+    ('comments', _fetch_comments, _apply_comments),
+    ('contributions', _fetch_contribs, _apply_contribs),
+    ('campaign status', _fetch_campaign_status, _apply_campaign_status),
+    ('perks status', _fetch_perks_status, _apply_perks_status),
+]
 
 
 def _convert_to_ts(s):
+    """Convert an ISO 8601 timestamp to UTC epoch seconds.
+    """
+    ts = TS_CACHE.get(s)
+    if ts is None:
+        ts = _parse_ts(s)
+        TS_CACHE.put(s, ts)
+    return ts
+
+
+def _parse_ts(s):
+    global API_OFFSET
+    # Fast path for the format of the API, e.g. 2015-11-23T19:30:51-08:00
+    match = TS_RE.match(s)
+    if match is None:
+        return _parse_ts_slow(s)
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    try:
+        days = datetime.date(int(year), int(month), int(day)).toordinal() - EPOCH_ORDINAL
+    except ValueError:
+        return _parse_ts_slow(s)
+    ts = days * 86400.0 + int(hour) * 3600 + int(minute) * 60 + int(second)
+    if fraction:
+        ts += int(fraction) / 10.0 ** len(fraction)
+    offset = 0
+    if zone != 'Z':
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        if zone[0] == '-':
+            offset = -offset
+        ts -= offset
+    API_OFFSET = offset
+    return ts
+
+
+def _parse_ts_slow(s):
+    global API_OFFSET
+    import iso8601
     d = iso8601.parse_date(s)
-    return time.mktime(d.timetuple())
+    API_OFFSET = d.utcoffset().days * 86400 + d.utcoffset().seconds
+    return calendar.timegm(d.utctimetuple()) + d.microsecond / 1e6
+
+
+class LruCache(object):
+    """Approximate LRU cache made of two generations of plain dicts.
+
+    A hit costs a dict lookup. When the young generation fills up, it
+    becomes the old one and whatever wasn't used since is dropped, which is
+    close to LRU and far cheaper than keeping an exact order.
+    """
+
+    def __init__(self, size):
+        self.half = max(1, size // 2)
+        self.young = {}
+        self.old = {}
+
+    def get(self, key):
+        value = self.young.get(key)
+        if value is None:
+            value = self.old.get(key)
+            if value is not None:
+                self.put(key, value)
+        return value
 
+    def put(self, key, value):
+        young = self.young
+        young[key] = value
+        if len(young) >= self.half:
+            self.old = young
+            self.young = {}
 
-def _build_comments_url(ident):
+
+TS_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?(Z|[+-]\d\d:?\d\d)$')
+TS_CACHE = LruCache(10000)
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+# UTC offset in seconds of the last parsed timestamp, to migrate older cursors
+API_OFFSET = None
+
+
+def _build_comments_url(campaign, ident):
     return 'https://www.indiegogo.com/projects/{slug}/x/{account_id}#/comments?id={ident}'.format(
-        slug=CONFIGS['slug'],
+        slug=campaign.slug,
         account_id=CONFIGS['account_id'],
         ident=ident)
 
 
-def _build_contrib_url(ident):
+def _build_contrib_url(campaign, ident):
     return 'https://www.indiegogo.com/command_center/{slug}#/contributions/{ident}'.format(
-        slug=CONFIGS['slug'],
+        slug=campaign.slug,
         ident=ident)
 
 
+def _format_duration(seconds):
+    if seconds < 3600:
+        return '{} minutes'.format(int(seconds / 60) + 1)
+    if seconds < 86400 * 2:
+        return '{:.1f} hours'.format(seconds / 3600)
+    return '{:.1f} days'.format(seconds / 86400)
+
+
 def _prompt_required(msg, retry_msg):
     ret = raw_input(msg)
     while not ret:
@@ -571,10 +3043,44 @@ def _prompt_yes_no(question, default_yes=True):
         return default_yes
 
 
+IMPORTED = time.time()
+
+
 if __name__ == '__main__':
     #logging.getLogger().setLevel(logging.INFO)
+    import argparse
+    parser = argparse.ArgumentParser(description='Indiegogo Campaign Monitor')
+    parser.add_argument('--once', action='store_true',
+                        help='check the campaigns once and exit instead of monitoring them')
+    parser.add_argument('--checks',
+                        help='comma separated checks to run with --once, e.g. "comments,contributions"')
+    parser.add_argument('--report', action='store_true',
+                        help='print the import, authentication and first cycle times with --once')
+    parser.add_argument('--worker', metavar='ID',
+                        help='monitor a share of the campaigns along with other workers (each with its own ID)')
+    parser.add_argument('--tail-events', type=int, metavar='OFFSET',
+                        help='print the logged events from the offset on as JSON lines and follow them')
+    args = parser.parse_args()
+    _load_configs()
+    if args.tail_events is not None:
+        if _events() is None:
+            sys.exit("The event log is disabled.")
+        try:
+            for event in _events().tail(args.tail_events):
+                print json.dumps(event)
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+    auth_started = time.time()
     if len(CONFIGS) == 0:
         ftl()
     else:
         authenticate()
-    start()
+    if args.worker:
+        run_worker(args.worker)
+    elif args.once:
+        run_once(names=args.checks and [name.strip() for name in args.checks.split(',')],
+                 report=args.report, auth_time=time.time() - auth_started)
+    else:
+        start()
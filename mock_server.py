@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the Indiegogo API, Slack and IFTTT.
+
+It serves a synthetic campaign with perks and paginated comments and
+contributions of configurable sizes, optionally slowed down by a fixed
+latency, and records the Slack and IFTTT posts it receives.
+
+    python mock_server.py --port 8000 --comments 1000 --contribs 5000
+
+Point igg.py at it by setting `igg.BASE_URL` to http://localhost:8000/1.1,
+`igg.IFTTT_URL` to http://localhost:8000/ifttt/{event}/{key} and the Slack
+URL to http://localhost:8000/slack.
+
+An access token of "expired" is rejected with 401, and POST /oauth/token
+hands out new tokens.
+
+Besides the API, it answers:
+    GET  /_stats  request counts per endpoint and the received posts
+    POST /_reset  reset the counts
+    POST /_grow?kind=comments&count=10  add new comments or contributions
+"""
+
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import re
+import socket
+import sys
+import threading
+import time
+import urlparse
+
+
+EPOCH = 1446336000  # 2015-11-01T00:00:00Z
+
+
+class Campaign(object):
+    """Synthetic campaign data.
+    """
+
+    def __init__(self, ident=1, comments=100, contribs=100, perks=10,
+                 referrers=10, page_size=10):
+        self.ident = ident
+        self.page_size = page_size
+        self.referrers = referrers
+        self.perks = [{'id': i,
+                       'label': u'Perk {}'.format(i),
+                       'amount': 10 * (i + 1),
+                       'number_claimed': 0,
+                       'number_available': 100 if i % 2 else None}
+                      for i in range(perks)]
+        self.items = {'comments': [], 'contributions': []}
+        self.lock = threading.Lock()
+        self.grow('comments', comments)
+        self.grow('contributions', contribs)
+
+    def grow(self, kind, count):
+        with self.lock:
+            items = self.items[kind]
+            for _ in range(count):
+                i = len(items)
+                created_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(EPOCH + i * 60))
+                if kind == 'comments':
+                    items.append({'id': i,
+                                  'created_at': created_at,
+                                  'text': u'Comment {}'.format(i),
+                                  'account': {'id': 1000 + i, 'avatar_url': 'http://example.com/a.png'}})
+                    continue
+                perk = self.perks[i % len(self.perks)] if self.perks and i % 5 else None
+                if perk:
+                    perk['number_claimed'] += 1
+                contrib = {'id': i,
+                           'created_at': created_at,
+                           'amount': perk['amount'] if perk else 5,
+                           'perk': perk and {'id': perk['id'], 'label': perk['label']},
+                           'by': u'Backer {}'.format(i),
+                           'avatar_url': 'http://example.com/b.png'}
+                if self.referrers and i % 3 == 0:
+                    contrib['referrer_id'] = 2000 + i % self.referrers
+                items.append(contrib)
+
+    def info(self):
+        with self.lock:
+            funds = sum(c['amount'] for c in self.items['contributions'])
+        return {'id': self.ident,
+                'title': u'Campaign {}'.format(self.ident),
+                'slug': 'campaign-{}'.format(self.ident),
+                'preview_url': 'http://example.com/preview',
+                'thumbnail_image_url': 'http://example.com/thumb.png',
+                'goal': 1000,
+                'collected_funds': funds,
+                'team_members': [{'account_id': 1}]}
+
+    def page(self, kind, page, per_page=None):
+        per_page = per_page or self.page_size
+        with self.lock:
+            # Newest first like the real API
+            items = self.items[kind][::-1]
+        return items[(page - 1) * per_page:page * per_page]
+
+
+WORDS = ['smart', 'robot', 'solar', 'coffee', 'camera', 'drone', 'watch', 'bike', 'light', 'speaker',
+         'wallet', 'backpack', 'garden', 'board', 'game', 'kitchen', 'pocket', 'travel', 'music', 'pet']
+
+
+def catalogue(count, first_id=100):
+    """Return synthetic campaigns with random-ish titles, newest first.
+    """
+    campaigns = []
+    for i in range(count):
+        words = [WORDS[(i * 7 + k * 3) % len(WORDS)] for k in range(3)]
+        campaigns.append({'id': first_id + i,
+                          'title': u' '.join(words).title() + u' {}'.format(i),
+                          'slug': '-'.join(words) + '-{}'.format(i),
+                          'team_members': [{'account_id': 3000 + i % 50}]})
+    return campaigns[::-1]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        self.server.count(re.sub(r'/\d+(?=/|\.json)', '/N', url.path))
+        time.sleep(self.server.latency)
+        if url.path == '/_stats':
+            return self._send(200, self.server.stats())
+        if params.get('access_token') == 'expired':
+            return self._send(401, {'error': 'invalid_token'})
+        campaign = self.server.campaign
+        page = int(params.get('page', 1))
+        per_page = int(params['per_page']) if 'per_page' in params else None
+        match = re.match(r'^/1.1/campaigns/\d+(/\w+)?\.json$', url.path)
+        if match and not match.group(1):
+            return self._send(200, {'response': campaign.info()})
+        if match and match.group(1) == '/perks':
+            return self._send(200, {'response': campaign.perks})
+        if match and match.group(1) in ('/comments', '/contributions'):
+            return self._send(200, {'response': campaign.page(match.group(1)[1:], page, per_page)})
+        match = re.match(r'^/1.1/accounts/(\d+)\.json$', url.path)
+        if match:
+            return self._send(200, {'response': {'id': int(match.group(1)),
+                                                 'name': u'Referrer {}'.format(match.group(1))}})
+        if url.path == '/1.1/me.json':
+            return self._send(200, {'response': {'id': 1, 'name': u'Me'}})
+        if url.path in ('/1.1/campaigns.json', '/1.1/search/campaigns.json'):
+            campaigns = self.server.catalogue + [campaign.info()]
+            if 'title' in params:
+                terms = params['title'].lower().split()
+                campaigns = [c for c in campaigns if all(term in c['title'].lower() for term in terms)]
+            per_page = per_page or campaign.page_size
+            return self._send(200, {'response': campaigns[(page - 1) * per_page:page * per_page]})
+        self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.server.count(re.sub(r'/ifttt/.*', '/ifttt', url.path))
+        time.sleep(self.server.latency)
+        if url.path == '/_reset':
+            self.server.reset()
+            return self._send(200, {})
+        if url.path == '/_grow':
+            self.server.campaign.grow(params.get('kind', 'contributions'), int(params.get('count', 1)))
+            return self._send(200, {})
+        if url.path == '/oauth/token':
+            return self._send(200, {'access_token': 'access', 'refresh_token': 'refresh', 'expires_in': 3600})
+        if url.path == '/slack' or url.path.startswith('/ifttt/'):
+            self.server.record(url.path, body)
+            return self._send(200, 'ok')
+        self._send(404, {'error': 'not found'})
+
+    def _send(self, status, data):
+        body = data if isinstance(data, basestring) else json.dumps(data)
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status, body = 304, ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 200:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, campaign, port=0, latency=0, campaigns=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.campaign = campaign
+        self.catalogue = catalogue(campaigns)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    def handle_error(self, request, client_address):
+        # Clients closing their keep-alive connections aren't worth a traceback.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def record(self, path, body):
+        with self.lock:
+            self.posts.append({'path': path, 'body': json.loads(body)})
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.posts = []
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'posts': list(self.posts)}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local Indiegogo/Slack/IFTTT stand-in.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--comments', type=int, default=100)
+    parser.add_argument('--contribs', type=int, default=100)
+    parser.add_argument('--perks', type=int, default=10)
+    parser.add_argument('--referrers', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--campaigns', type=int, default=0, help='other campaigns listed and searched')
+    args = parser.parse_args()
+    campaign = Campaign(comments=args.comments, contribs=args.contribs, perks=args.perks,
+                        referrers=args.referrers, page_size=args.page_size)
+    server = MockServer(campaign, port=args.port, latency=args.latency, campaigns=args.campaigns)
+    print "Serving on {} (CTRL-c to stop)...".format(server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()